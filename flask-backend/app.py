@@ -1,20 +1,42 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import os
 import random
 import base64
-import json
+import hashlib
+import contextlib
 from datetime import datetime
 import logging
 import socket
+import sys
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
+import circuit_breaker
+import fast_json
+import http_client
+import jobs
+import metrics
+import rate_limit
+import receipt_parser
+import supabase_batch
+import supabase_cache
+import supabase_stream
+import uploads
+from singleflight import SingleFlight
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
+if fast_json.FAST_JSON_ENABLED:
+    app.json = fast_json.OrjsonProvider(app)
 
 # Define allowed origins
 ALLOWED_ORIGINS = [
@@ -37,7 +59,7 @@ if os.environ.get('CORS_ALLOWED_ORIGINS'):
         logger.error(f"Error parsing CORS_ALLOWED_ORIGINS: {e}")
 
 # Enable CORS for specific origins
-CORS(app, resources={r"/*": {"origins": ALLOWED_ORIGINS}})
+CORS(app, resources={r"/*": {"origins": ALLOWED_ORIGINS}}, expose_headers=['ETag', 'Retry-After', 'Content-Range'])
 
 # Supabase configuration - server-side only
 SUPABASE_URL = os.environ.get('SUPABASE_PROJECT_URL')
@@ -46,6 +68,38 @@ SUPABASE_KEY = os.environ.get('SUPABASE_API_KEY')
 # Gemini API configuration - server-side only
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 
+# trash_scanner.py lives at the repository root. Make it importable when the
+# backend runs from a full checkout; deployments that only ship flask-backend/
+# keep returning mock classifications.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import trash_scanner
+except ImportError as e:
+    logger.warning(f"trash_scanner unavailable, using mock classification: {e}")
+    trash_scanner = None
+
+# Report trash_scanner's stage timings and cache/fallback counts to /metrics
+if trash_scanner is not None and metrics.METRICS_ENABLED:
+    trash_scanner.metrics_hook = metrics.REGISTRY
+
+# Stop calling Gemini while it is failing and go straight to the fallbacks
+if trash_scanner is not None:
+    trash_scanner.gemini_breaker = circuit_breaker.get_breaker('gemini')
+receipt_breaker = circuit_breaker.get_breaker('gemini_receipt')
+
+# Bound concurrent Gemini calls and share them fairly between clients
+if trash_scanner is not None:
+    trash_scanner.upstream_scheduler = rate_limit.scheduler
+
+# Maximum number of images accepted by the batch classification endpoint
+MAX_BATCH_IMAGES = int(os.environ.get('MAX_BATCH_IMAGES', 64))
+# ...and the most bytes all of them may add up to
+MAX_BATCH_BYTES = int(os.environ.get('MAX_BATCH_BYTES', 16 * 1024 * 1024))
+
+# Concurrent identical uploads share one upstream call
+receipt_flights = SingleFlight()
+classify_flights = SingleFlight()
+
 @app.route('/api/test', methods=['GET', 'OPTIONS'])
 def test_api():
     """Test endpoint to verify API is working"""
@@ -83,6 +137,14 @@ def process_receipt():
         return handle_preflight()
     
     try:
+        # Reject oversized uploads before the body is parsed
+        if request.content_length and request.content_length > uploads.MAX_RECEIPT_BYTES:
+            return jsonify({'error': 'File too large', 'max_bytes': uploads.MAX_RECEIPT_BYTES}), 413
+        
+        limited = check_rate_limit('receipt')
+        if limited:
+            return limited
+        
         # Check if files were uploaded
         if 'file' not in request.files:
             return jsonify({'error': 'No file provided'}), 400
@@ -93,96 +155,165 @@ def process_receipt():
         
         logger.info(f"Processing receipt: {file.filename}")
         
-        # Read the file data
-        file_data = file.read()
-        
-        # Convert to base64 for Gemini API
-        base64_image = base64.b64encode(file_data).decode('utf-8')
+        try:
+            key, _ = uploads.hash_upload(file.stream)
+        except uploads.UploadTooLarge:
+            return jsonify({'error': 'File too large', 'max_bytes': uploads.MAX_RECEIPT_BYTES}), 413
         
-        # Prepare the request to Gemini API
-        gemini_url = 'https://api.gemini.com/v1/receipt'
+        # ?mode=job returns a job id at once instead of waiting on Gemini
+        if request.args.get('mode') == 'job' and job_queue is not None:
+            return submit_job('receipt', file.stream.read())
         
-        # Create form data for the Gemini API
-        form_data = {
-            'image': base64_image,
-            'format': 'json'
-        }
-        
-        # Make the request to Gemini API with server-side API key
-        headers = {
-            'Authorization': f'Bearer {GEMINI_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        logger.info("Sending request to Gemini API")
-        response = requests.post(gemini_url, json=form_data, headers=headers)
-        
-        # Check if the request was successful
-        if response.status_code != 200:
-            logger.error(f"Gemini API error: {response.status_code} - {response.text}")
-            
-            # If Gemini API is unavailable, use a fallback method
-            logger.info("Using fallback method for receipt processing")
-            result = process_receipt_fallback(base64_image)
-            return jsonify(result)
-        
-        # Process the Gemini API response
-        gemini_data = response.json()
-        
-        # Extract and process the data
-        extracted_text = gemini_data.get('text', '')
-        
-        # Process the receipt data (similar to the client-side logic)
-        result = {
-            'success': True,
-            'extracted_text': extracted_text,
-            'eco_score': calculate_eco_score(extracted_text),
-            'carbon_footprint': calculate_carbon_footprint(extracted_text),
-            'items': parse_receipt_items(extracted_text)
-        }
+        # Identical uploads in flight at the same time share one Gemini call
+        with metrics.span('receipt_request'):
+            result, shared = receipt_flights.do(key, lambda: process_receipt_data(file.stream))
+        if shared:
+            logger.info("Coalesced duplicate receipt request")
         
         return jsonify(result)
     except Exception as e:
         logger.error(f"Error processing receipt: {str(e)}")
         return jsonify({'error': 'Failed to process receipt', 'details': str(e)}), 500
 
-def process_receipt_fallback(base64_image):
-    """Fallback method for receipt processing when Gemini API is unavailable"""
-    # This is a simplified version that would normally use OCR like Tesseract
-    # For this example, we'll return mock data
+def process_receipt_data(fileobj):
+    """Send a receipt image to Gemini and build the client result"""
+    # Downsample to OCR resolution, then base64 it chunk by chunk into the request body
+    with metrics.span('receipt_downsample'):
+        image = uploads.downsample_receipt(fileobj)
+    return process_receipt_image(image)
+
+def process_receipt_image(image):
+    """Send an already downsampled receipt image to Gemini and build the client result"""
+    # Skip the upstream entirely while its circuit is open
+    if receipt_breaker is not None and receipt_breaker.is_open():
+        logger.info("Gemini receipt circuit is open, using fallback method")
+        metrics.count('fallbacks', 'receipt_circuit_open')
+        return process_receipt_fallback(image)
+    
+    def post():
+        # Build the streamed body per attempt so a hedged retry can send it again
+        gemini_url, body, headers = build_receipt_stream_request(image)
+        return http_client.request('POST', gemini_url, data=body, headers=headers)
+    
+    # Make the request to Gemini API with server-side API key
+    logger.info(f"Sending request to Gemini API ({len(image)} byte image)")
+    started = time.perf_counter()
+    try:
+        with upstream_slot():
+            if receipt_breaker is None:
+                response = post()
+            else:
+                response = receipt_breaker.call(
+                    post, is_failure=lambda r: circuit_breaker.is_upstream_failure(r.status_code))
+    except circuit_breaker.CircuitOpenError:
+        metrics.count('fallbacks', 'receipt_circuit_open')
+        return process_receipt_fallback(image)
+    except rate_limit.SlotTimeout:
+        metrics.count('fallbacks', 'receipt_overloaded')
+        return process_receipt_fallback(image)
+    except requests.RequestException as e:
+        # The breaker has already counted the failure; the client still gets a result
+        logger.error(f"Gemini API request failed: {str(e)}")
+        metrics.count('upstream_responses', 'gemini_receipt', 'error')
+        metrics.count('fallbacks', 'receipt')
+        return process_receipt_fallback(image)
+    finally:
+        metrics.observe_stage('receipt_upstream', time.perf_counter() - started)
+    metrics.count('upstream_responses', 'gemini_receipt', str(response.status_code))
+    
+    # Check if the request was successful
+    if response.status_code != 200:
+        logger.error(f"Gemini API error: {response.status_code} - {response.text}")
+        
+        # If Gemini API is unavailable, use a fallback method
+        logger.info("Using fallback method for receipt processing")
+        metrics.count('fallbacks', 'receipt')
+        return process_receipt_fallback(image)
+    
+    # Process the Gemini API response
+    return build_receipt_result(response.json())
+
+# Gemini receipt endpoint
+GEMINI_RECEIPT_URL = os.environ.get('GEMINI_RECEIPT_URL', 'https://api.gemini.com/v1/receipt')
+
+def build_receipt_stream_request(image):
+    """Build the URL, streamed JSON body and headers for a Gemini receipt request"""
+    body = uploads.iter_json_with_base64(b'{"image": "', image, b'", "format": "json"}')
+    return GEMINI_RECEIPT_URL, body, receipt_headers()
+
+def receipt_headers():
+    """Headers for Gemini receipt requests, with the server-side API key"""
+    return {
+        'Authorization': f'Bearer {GEMINI_API_KEY}',
+        'Content-Type': 'application/json'
+    }
+
+def build_receipt_result(gemini_data):
+    """Turn a Gemini receipt response into the JSON returned to the client"""
+    # Extract and process the data
+    extracted_text = gemini_data.get('text', '')
+    
+    # Parse once and derive the score and footprint from the same items
+    with metrics.span('receipt_parse'):
+        analysis = receipt_parser.analyze_receipt(extracted_text)
     return {
         'success': True,
-        'extracted_text': 'MOCK RECEIPT\nStore: Eco Grocery\nDate: 2023-05-15\nItems:\n1. Organic Apples $3.99\n2. Reusable Bags $1.50\n3. Local Produce $5.99\nTotal: $11.48',
-        'eco_score': 85,
-        'carbon_footprint': 0.8,
-        'items': [
-            {'name': 'Organic Apples', 'price': 3.99, 'isEcoFriendly': True},
-            {'name': 'Reusable Bags', 'price': 1.50, 'isEcoFriendly': True},
-            {'name': 'Local Produce', 'price': 5.99, 'isEcoFriendly': True}
-        ]
+        'extracted_text': extracted_text,
+        'eco_score': analysis['eco_score'],
+        'carbon_footprint': analysis['carbon_footprint'],
+        'items': analysis['items']
     }
 
+def process_receipt_fallback(image):
+    """Fallback method for receipt processing when Gemini API is unavailable"""
+    # This is a simplified version that would normally use OCR like Tesseract
+    # For this example, we parse mock receipt text
+    return build_receipt_result({
+        'text': 'MOCK RECEIPT\nStore: Eco Grocery\nDate: 2023-05-15\nItems:\n1. Organic Apples $3.99\n2. Reusable Bags $1.50\n3. Local Produce $5.99\nTotal: $11.48'
+    })
+
 def calculate_eco_score(text):
     """Calculate eco score based on receipt text"""
-    # This would normally analyze the items for eco-friendliness
-    # For this example, we'll return a mock score
-    return 75
+    return receipt_parser.calculate_eco_score(receipt_parser.parse_receipt_items(text))
 
 def calculate_carbon_footprint(text):
     """Calculate carbon footprint based on receipt text"""
-    # This would normally calculate based on items and quantities
-    # For this example, we'll return a mock value
-    return 1.2
+    return receipt_parser.calculate_carbon_footprint(receipt_parser.parse_receipt_items(text))
 
 def parse_receipt_items(text):
     """Parse receipt text into structured items"""
-    # This would normally use NLP to extract items, prices, etc.
-    # For this example, we'll return mock items
-    return [
-        {'name': 'Organic Vegetables', 'price': 4.99, 'isEcoFriendly': True},
-        {'name': 'Recycled Paper Towels', 'price': 2.99, 'isEcoFriendly': True},
-        {'name': 'Plastic Water Bottles', 'price': 3.99, 'isEcoFriendly': False}
-    ]
+    return receipt_parser.parse_receipt_items(text)
+
+# HTTP method used for each proxied Supabase operation
+SUPABASE_METHODS = {
+    'select': 'GET',
+    'insert': 'POST',
+    'update': 'PATCH',
+    'delete': 'DELETE'
+}
+
+def build_supabase_request(table, operation, query_params, payload, auth_token):
+    """Build the method, URL and request arguments for a PostgREST call"""
+    # Construct Supabase API URL
+    url = f"{SUPABASE_URL}/rest/v1/{table}"
+    
+    # Set up headers
+    headers = {
+        'apikey': SUPABASE_KEY,
+        'Content-Type': 'application/json'
+    }
+    
+    # Add authorization if provided
+    if auth_token:
+        headers['Authorization'] = auth_token
+    
+    request_kwargs = {'headers': headers}
+    # Filters apply to everything except inserts; bodies only to writes
+    if operation != 'insert':
+        request_kwargs['params'] = query_params
+    if operation in ('insert', 'update'):
+        request_kwargs['json'] = payload
+    return SUPABASE_METHODS[operation], url, request_kwargs
 
 @app.route('/api/supabase/data', methods=['POST', 'OPTIONS'])
 def supabase_data():
@@ -208,41 +339,156 @@ def supabase_data():
         
         logger.info(f"Supabase operation: {operation} on table: {table}")
         
-        # Construct Supabase API URL
-        url = f"{SUPABASE_URL}/rest/v1/{table}"
-        
-        # Set up headers
-        headers = {
-            'apikey': SUPABASE_KEY,
-            'Content-Type': 'application/json'
-        }
+        if operation not in SUPABASE_METHODS:
+            return jsonify({'error': 'Invalid operation'}), 400
         
-        # Add authorization if provided
-        if auth_token:
-            headers['Authorization'] = auth_token
+        # Large uncached selects go straight through to the client, unparsed
+        if passthrough_select(table, operation):
+            return stream_supabase(table, query_params, auth_token)
         
         # Perform the operation
-        if operation == 'select':
-            # Handle select operation
-            response = requests.get(url, headers=headers, params=query_params)
-        elif operation == 'insert':
-            # Handle insert operation
-            response = requests.post(url, headers=headers, json=data.get('data', {}))
-        elif operation == 'update':
-            # Handle update operation
-            response = requests.patch(url, headers=headers, json=data.get('data', {}), params=query_params)
-        elif operation == 'delete':
-            # Handle delete operation
-            response = requests.delete(url, headers=headers, params=query_params)
-        else:
-            return jsonify({'error': 'Invalid operation'}), 400
+        status, body, etag = fetch_supabase(table, operation, query_params, data.get('data', {}), auth_token)
+        if etag is not None:
+            return select_response(body, status, etag)
         
-        # Return the response from Supabase
-        return jsonify(response.json() if response.text else {}), response.status_code
+        # Return the response from Supabase as-is; an empty write response becomes {}
+        return app.response_class(body or b'{}', status=status, mimetype='application/json')
     except Exception as e:
         logger.error(f"Error in Supabase operation: {str(e)}")
         return jsonify({'error': 'Failed to perform Supabase operation'}), 500
 
+def fetch_supabase(table, operation, query_params, payload, auth_token, prefer=None):
+    """Run one PostgREST operation through the select cache.
+    
+    Returns (status, body bytes, etag); etag is None for writes.
+    """
+    # Serve repeated selects from memory
+    select_cache = supabase_cache.select_cache
+    if operation == 'select':
+        key = supabase_cache.cache_key(table, query_params, auth_token)
+        cached = select_cache.get(key) if select_cache.ttl_for(table) else None
+        metrics.count('supabase_cache', 'hit' if cached is not None else 'miss')
+        if cached is not None:
+            return cached.status, cached.body, cached.etag
+        generation = select_cache.generation(table)
+    
+    method, url, request_kwargs = build_supabase_request(table, operation, query_params, payload, auth_token)
+    if prefer:
+        request_kwargs['headers']['Prefer'] = prefer
+    started = time.perf_counter()
+    try:
+        response = http_client.request(method, url, **request_kwargs)
+    except Exception:
+        metrics.count('upstream_responses', 'supabase', 'error')
+        raise
+    finally:
+        metrics.observe_stage('supabase_upstream', time.perf_counter() - started)
+    metrics.count('upstream_responses', 'supabase', str(response.status_code))
+    
+    if operation == 'select':
+        entry = select_cache.put(key, generation, response.content or b'{}', response.status_code)
+        return entry.status, entry.body, entry.etag
+    
+    # Writes make cached selects of the table stale
+    select_cache.invalidate(table)
+    return response.status_code, response.content, None
+
+def passthrough_select(table, operation):
+    """Whether a proxied operation can be streamed without buffering its body"""
+    # Cached tables and revalidations need the whole body for the cache and the ETag
+    return (supabase_stream.SUPABASE_PASSTHROUGH_ENABLED and operation == 'select'
+            and not supabase_cache.select_cache.ttl_for(table) and not request.headers.get('If-None-Match'))
+
+def stream_supabase(table, query_params, auth_token):
+    """Relay a PostgREST select to the client chunk by chunk, still compressed if it accepts that"""
+    method, url, request_kwargs = build_supabase_request(table, 'select', query_params, None, auth_token)
+    accept_encoding = request.headers.get('Accept-Encoding')
+    request_kwargs['headers']['Accept-Encoding'] = supabase_stream.upstream_accept_encoding(accept_encoding)
+    started = time.perf_counter()
+    try:
+        response = http_client.request(method, url, stream=True, **request_kwargs)
+    except Exception:
+        metrics.count('upstream_responses', 'supabase', 'error')
+        raise
+    finally:
+        metrics.observe_stage('supabase_upstream', time.perf_counter() - started)
+    metrics.count('upstream_responses', 'supabase', str(response.status_code))
+    
+    headers, decode = supabase_stream.response_headers(response.headers, accept_encoding)
+    decoder = None
+    if decode:
+        # Upstream ignored our Accept-Encoding
+        decoder = supabase_stream.content_decoder(response.headers.get('Content-Encoding', '').strip().lower())
+        if decoder is None:
+            response.close()
+            return jsonify({'error': 'Unsupported upstream content encoding'}), 502
+    metrics.count('supabase_passthrough', headers.get('Content-Encoding', 'identity'))
+    return app.response_class(supabase_stream.iter_body(response, decoder), status=response.status_code,
+                              headers=headers, direct_passthrough=True)
+
+def select_response(body, status, etag):
+    """Send a select body as-is, or 304 if the client already has this version"""
+    if status == 200 and supabase_cache.etag_matches(request.headers.get('If-None-Match'), etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, status=status, mimetype='application/json')
+    response.headers['ETag'] = etag
+    return response
+
+# Runs the concurrent lanes of a Supabase batch phase (consecutive reads, or
+# the tables of a batch marked parallel)
+supabase_batch_pool = ThreadPoolExecutor(max_workers=supabase_batch.BATCH_CONCURRENCY)
+
+@app.route('/api/supabase/batch', methods=['POST', 'OPTIONS'])
+def supabase_batch_data():
+    """Run an ordered list of Supabase operations in one request"""
+    if request.method == 'OPTIONS':
+        # Handle preflight request
+        return handle_preflight()
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        operations = data.get('operations')
+        if not isinstance(operations, list) or not operations:
+            return jsonify({'error': 'Expected a non-empty "operations" array'}), 400
+        if len(operations) > supabase_batch.MAX_BATCH_OPERATIONS:
+            return jsonify({'error': f'At most {supabase_batch.MAX_BATCH_OPERATIONS} operations per batch'}), 400
+        
+        auth_token = request.headers.get('Authorization')
+        phases, errors = supabase_batch.plan_batch(operations, SUPABASE_METHODS, parallel=data.get('parallel') is True)
+        logger.info(f"Supabase batch: {len(operations)} operations in "
+                    f"{supabase_batch.count_steps(phases)} upstream calls in {len(phases)} phases")
+        
+        def run_lane(steps):
+            results = []
+            for step in steps:
+                results.extend(run_supabase_step(step, auth_token))
+            return results
+        
+        step_results = []
+        for lanes in phases:
+            if len(lanes) == 1:
+                step_results.extend(run_lane(lanes[0]))
+                continue
+            for results in supabase_batch_pool.map(run_lane, lanes):
+                step_results.extend(results)
+        return jsonify({'results': supabase_batch.ordered_results(len(operations), errors, step_results)})
+    except Exception as e:
+        logger.error(f"Error in Supabase batch: {str(e)}")
+        return jsonify({'error': 'Failed to perform Supabase operation'}), 500
+
+def run_supabase_step(step, auth_token):
+    """Run one planned batch step and return per-operation results"""
+    try:
+        status, body, _ = fetch_supabase(
+            step.table, step.operation, step.params, supabase_batch.step_payload(step), auth_token,
+            prefer=supabase_batch.step_prefer(step))
+    except Exception as e:
+        logger.error(f"Error in Supabase batch operation on {step.table}: {str(e)}")
+        return [supabase_batch.error_result(index, 'Failed to perform Supabase operation')
+                for index in step.indexes]
+    return supabase_batch.split_results(step, status, body)
+
 @app.route('/api/classify-trash', methods=['POST', 'OPTIONS'])
 def classify_trash():
     """Classify trash images"""
@@ -251,23 +497,383 @@ def classify_trash():
         return handle_preflight()
     
     try:
-        # Get the image data from the request
-        data = request.json
-        if not data or 'image' not in data:
-            return jsonify({'error': 'No image data provided'}), 400
+        limited = check_rate_limit('classify')
+        if limited:
+            return limited
         
-        image_data = data['image']
-        logger.info(f"Received image data of length: {len(image_data)}")
+        # The Content-Type picks the format: raw image bytes, multipart, or base64 in JSON
+        key = None
+        if request.mimetype in BINARY_IMAGE_TYPES or request.mimetype == 'multipart/form-data':
+            try:
+                key, image_bytes = read_image_upload()
+            except uploads.UploadTooLarge:
+                return jsonify({'error': 'File too large', 'max_bytes': uploads.MAX_IMAGE_BYTES}), 413
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            image_data = None
+            logger.info(f"Received {len(image_bytes)} byte image as {request.mimetype}")
+        elif request.is_json:
+            data = request.json
+            if not data or 'image' not in data:
+                return jsonify({'error': 'No image data provided'}), 400
+            image_data = data['image']
+            logger.info(f"Received image data of length: {len(image_data)}")
+        else:
+            return unsupported_image_type()
         
-        # In a real implementation, you would process the image and classify it
-        # For now, we'll return a mock result
-        result = generate_mock_result()
+        # ?mode=stream sends each field as a Server-Sent Event as soon as Gemini writes it
+        streaming = request.args.get('mode') == 'stream'
+        if not scanner_enabled():
+            # Without trash_scanner (or a Gemini key) we return a mock result
+            if streaming:
+                return event_stream_response([('result', generate_mock_result())])
+            return mock_result_response()
         
-        return jsonify(result)
+        if image_data is not None:
+            try:
+                image_bytes = decode_image_data(image_data)
+            except ValueError:
+                return jsonify({'error': 'Invalid image data'}), 400
+        
+        # ?mode=job returns a job id at once instead of waiting on Gemini
+        if request.args.get('mode') == 'job' and job_queue is not None:
+            return submit_job('scan', image_bytes)
+        
+        if streaming:
+            # Not coalesced: each stream needs its own partial fields as they arrive
+            response = capped_event_stream(lambda: (
+                jobs.format_event(event, data) for event, data in trash_scanner.classify_trash_stream(image_bytes)))
+            if response is not None:
+                return response
+            # At the cap, answer with the whole result; the web app accepts either
+            logger.info("Too many event streams open, answering ?mode=stream with plain JSON")
+        
+        # Identical images in flight at the same time share one classification
+        key = key or hashlib.sha256(image_bytes).hexdigest()
+        with metrics.span('classify_request'):
+            result, shared = classify_flights.do(key, lambda: classify_images([image_bytes])[0])
+        if shared:
+            logger.info("Coalesced duplicate classification request")
+        if 'error' in result:
+            return jsonify({'error': 'Failed to classify trash', 'details': result['error']}), 500
+        return jsonify(result['result'])
     except Exception as e:
         logger.error(f"Error classifying trash: {str(e)}")
         return jsonify({'error': 'Failed to classify trash'}), 500
 
+@app.route('/api/classify-trash/batch', methods=['POST', 'OPTIONS'])
+def classify_trash_batch():
+    """Classify several trash images in one request"""
+    if request.method == 'OPTIONS':
+        # Handle preflight request
+        return handle_preflight()
+    
+    try:
+        # Reject oversized batches before the body is parsed
+        if request.content_length and request.content_length > MAX_BATCH_BYTES:
+            return batch_too_large()
+        
+        # Accept either multipart uploads or a JSON array of base64 strings
+        if request.files:
+            entries = request.files.getlist('images')
+        else:
+            data = request.get_json(silent=True) or {}
+            entries = data.get('images')
+            if not isinstance(entries, list):
+                return jsonify({'error': 'Expected an "images" array'}), 400
+        
+        if not entries:
+            return jsonify({'error': 'No images provided'}), 400
+        if len(entries) > MAX_BATCH_IMAGES:
+            return jsonify({'error': f'At most {MAX_BATCH_IMAGES} images per batch'}), 400
+        if request.files:
+            try:
+                entries = read_batch_uploads(entries)
+            except uploads.UploadTooLarge:
+                return batch_too_large()
+        
+        # Each image is its own upstream call
+        limited = check_rate_limit('classify_batch', cost=len(entries))
+        if limited:
+            return limited
+        
+        logger.info(f"Classifying batch of {len(entries)} images")
+        return jsonify({'results': classify_batch(entries)})
+    except Exception as e:
+        logger.error(f"Error classifying trash batch: {str(e)}")
+        return jsonify({'error': 'Failed to classify trash'}), 500
+
+def run_receipt_job(payload):
+    """Job handler: downsample a receipt in the process pool, then process it"""
+    image = jobs.run_in_process(uploads.downsample_receipt_bytes, payload)
+    return process_receipt_image(image)
+
+def run_scan_job(payload):
+    """Job handler: classify one image, preprocessing it in the worker pool"""
+    if not scanner_enabled():
+        return generate_mock_result()
+    item = trash_scanner.classify_many([payload], concurrency=1)[0]
+    if 'error' in item:
+        raise RuntimeError(item['error'])
+    return item['result']
+
+# Background jobs shared by every worker process through one SQLite file
+job_queue = None
+if jobs.JOBS_ENABLED:
+    try:
+        job_queue = jobs.JobQueue(jobs.JOB_DB_PATH, {'receipt': run_receipt_job, 'scan': run_scan_job},
+                                  run_as=rate_limit.client_scope)
+    except sqlite3.Error as e:
+        logger.error(f"Disabling the job queue: {str(e)}")
+
+def submit_job(kind, payload):
+    """Queue a job and answer 202 with where to poll for its result"""
+    try:
+        job_id = job_queue.submit(kind, payload, owner=rate_limit.current_client.get())
+    except jobs.QueueFull:
+        return jsonify({'error': 'Too many queued jobs, try again later'}), 503, {'Retry-After': '5'}
+    links = job_links(job_id)
+    return jsonify(links), 202, {'Location': links['status_url']}
+
+def job_links(job_id):
+    """Body of a 202 reply to a job submission"""
+    return {
+        'job_id': job_id,
+        'status': jobs.QUEUED,
+        'status_url': f'/api/jobs/{job_id}',
+        'events_url': f'/api/jobs/{job_id}/events'
+    }
+
+@app.route('/api/jobs/<job_id>', methods=['GET', 'OPTIONS'])
+def job_status(job_id):
+    """Current status of a background job, with its result once finished"""
+    if request.method == 'OPTIONS':
+        # Handle preflight request
+        return handle_preflight()
+    
+    job = job_queue.get(job_id) if job_queue is not None else None
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+# Keep proxies from buffering or caching event streams
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+# Each open stream holds a worker thread for as long as it lasts (up to
+# JOB_EVENTS_TIMEOUT for job events), so only this many may be open per
+# process; by default half of the gthread threads
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', max(1, int(os.environ.get('GUNICORN_THREADS', 8)) // 2)))
+sse_streams = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+class _StreamSlot:
+    """Iterate a stream's chunks while holding one of the SSE_MAX_STREAMS slots"""
+    
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._released = False
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        return next(self._chunks)
+    
+    def close(self):
+        # The WSGI server calls this when the stream ends or the client goes away
+        if not self._released:
+            self._released = True
+            sse_streams.release()
+            close = getattr(self._chunks, 'close', None)
+            if close is not None:
+                close()
+
+def capped_event_stream(make_chunks):
+    """An event stream response for the chunks from make_chunks(), or None at the cap"""
+    if not sse_streams.acquire(blocking=False):
+        metrics.count('event_streams', 'rejected')
+        return None
+    try:
+        chunks = _StreamSlot(iter(make_chunks()))
+    except BaseException:
+        sse_streams.release()
+        raise
+    return Response(chunks, mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-Sent Events stream of a background job's status changes"""
+    job = job_queue.get(job_id) if job_queue is not None else None
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    response = capped_event_stream(lambda: stream_job_events(job))
+    if response is None:
+        # Polling costs a thread only for the moment each poll takes
+        return jsonify({'error': 'Too many event streams, poll status_url instead',
+                        'status_url': job_links(job_id)['status_url']}), 503, {'Retry-After': '5'}
+    return response
+
+def stream_job_events(job):
+    """Yield a "status" event per change and a final "done" event with the job"""
+    yield 'retry: 2000\n\n'
+    deadline = time.monotonic() + jobs.JOB_EVENTS_TIMEOUT
+    status = None
+    while job is not None and time.monotonic() < deadline:
+        if job['status'] in jobs.FINISHED:
+            yield jobs.format_event('done', job)
+            return
+        if job['status'] != status:
+            status = job['status']
+            yield jobs.format_event('status', {'id': job['id'], 'status': status})
+        else:
+            yield ': keep-alive\n\n'
+        job = job_queue.wait(job['id'], status, jobs.JOB_HEARTBEAT_SECONDS)
+
+def event_stream_response(events):
+    """Respond with (event, data) pairs as a stream of Server-Sent Events"""
+    return Response((jobs.format_event(event, data) for event, data in events),
+                    mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics: per-stage latency histograms and event counters"""
+    if not metrics.METRICS_ENABLED:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+def check_rate_limit(route, cost=1):
+    """Charge the caller for upstream work; returns a 429 response if they are over the limit"""
+    client = rate_limit.client_key(request.headers.get('Authorization'), request.remote_addr,
+                                   request.headers.get('X-Forwarded-For'))
+    # Upstream calls made for this request are scheduled as this client's
+    rate_limit.current_client.set(client)
+    if rate_limit.limiter is None:
+        return None
+    retry_after = rate_limit.limiter.check(client, cost)
+    if not retry_after:
+        return None
+    metrics.count('rate_limited', route)
+    return rate_limited_response(retry_after)
+
+def rate_limited_response(retry_after):
+    """429 reply telling the client when to try again"""
+    header = rate_limit.retry_after_header(retry_after)
+    return (jsonify({'error': 'Too many requests, please slow down', 'retry_after': int(header)}), 429,
+            {'Retry-After': header})
+
+def upstream_slot():
+    """Hold a fair-share upstream slot for the current client, if scheduling is on"""
+    if rate_limit.scheduler is None:
+        return contextlib.nullcontext()
+    return rate_limit.scheduler.slot()
+
+def scanner_enabled():
+    """Whether real classification through trash_scanner is available"""
+    return trash_scanner is not None and not trash_scanner.USE_MOCK_RESPONSE
+
+# Raw image bodies /api/classify-trash accepts besides JSON and multipart
+BINARY_IMAGE_TYPES = ('application/octet-stream', 'image/jpeg', 'image/webp', 'image/png')
+ACCEPTED_SCAN_TYPES = ', '.join(BINARY_IMAGE_TYPES + ('multipart/form-data', 'application/json'))
+
+def read_image_upload():
+    """Read a raw or multipart image upload from the request stream.
+    
+    Returns a (sha256 hex digest, image bytes) tuple. The body is hashed and
+    size-checked chunk by chunk, with no base64 or JSON text in between.
+    """
+    if request.content_length and request.content_length > uploads.MAX_IMAGE_BYTES:
+        raise uploads.UploadTooLarge(f'Upload exceeds {uploads.MAX_IMAGE_BYTES} bytes')
+    if request.mimetype == 'multipart/form-data':
+        file = request.files.get('image') or request.files.get('file')
+        if file is None:
+            raise ValueError('No image file provided')
+        stream = file.stream
+    else:
+        stream = request.stream
+    key, image_bytes = uploads.read_upload(stream, uploads.MAX_IMAGE_BYTES)
+    if not image_bytes:
+        raise ValueError('Image data is empty')
+    return key, image_bytes
+
+def read_batch_uploads(files):
+    """Read multipart batch images through size-checked buffers.
+    
+    Raises UploadTooLarge once an image passes MAX_IMAGE_BYTES or the batch
+    passes MAX_BATCH_BYTES, without reading the rest.
+    """
+    images = []
+    remaining = MAX_BATCH_BYTES
+    for file in files:
+        _, image = uploads.read_upload(file.stream, min(uploads.MAX_IMAGE_BYTES, remaining))
+        remaining -= len(image)
+        images.append(image)
+    return images
+
+def batch_too_large():
+    """413 reply for a batch over the per-image or per-batch size limit"""
+    return jsonify({'error': 'File too large', 'max_bytes': uploads.MAX_IMAGE_BYTES,
+                    'max_batch_bytes': MAX_BATCH_BYTES}), 413
+
+def unsupported_image_type():
+    """415 reply listing the upload formats that are accepted"""
+    return (jsonify({'error': 'Unsupported image upload format', 'accepted': ACCEPTED_SCAN_TYPES}), 415,
+            {'Accept-Post': ACCEPTED_SCAN_TYPES})
+
+def decode_image_data(image_data):
+    """Decode a base64 image string, with or without a data URI prefix"""
+    if not isinstance(image_data, str):
+        raise ValueError('Image data must be a base64 string')
+    if image_data.startswith('data:'):
+        image_data = image_data.split(',', 1)[-1]
+    try:
+        image_bytes = base64.b64decode(image_data, validate=True)
+    except (ValueError, TypeError):
+        raise ValueError('Image data is not valid base64')
+    if not image_bytes:
+        raise ValueError('Image data is empty')
+    return image_bytes
+
+def classify_batch(entries):
+    """Classify raw bytes or base64 strings, returning per-item results in order"""
+    results, images, indexes = decode_batch(entries)
+    if scanner_enabled():
+        classified = classify_images(images)
+    else:
+        classified = [{'result': generate_mock_result()} for _ in images]
+    return merge_batch_results(results, indexes, classified)
+
+def decode_batch(entries):
+    """Decode batch entries; returns (results with errors filled in, images, their indexes)"""
+    results = [None] * len(entries)
+    images = []
+    indexes = []
+    for index, entry in enumerate(entries):
+        try:
+            image_bytes = entry if isinstance(entry, bytes) else decode_image_data(entry)
+            if not image_bytes:
+                raise ValueError('Image data is empty')
+        except ValueError as e:
+            results[index] = {'index': index, 'error': str(e)}
+            continue
+        images.append(image_bytes)
+        indexes.append(index)
+    return results, images, indexes
+
+def merge_batch_results(results, indexes, classified):
+    """Put each classified image's result back at its index in the batch"""
+    for index, item in zip(indexes, classified):
+        results[index] = dict(item, index=index)
+    return results
+
+def classify_images(images):
+    """Classify raw image bytes with trash_scanner, preserving order"""
+    if len(images) == 1:
+        # A single image is not worth a trip through the preprocessing pool
+        return [{'result': trash_scanner.classify_trash(images[0])}]
+    return [
+        {key: value for key, value in item.items() if key != 'image'}
+        for item in trash_scanner.classify_many(images)
+    ]
+
 def handle_preflight():
     """Handle preflight CORS requests"""
     response = jsonify({'status': 'ok'})
@@ -275,59 +881,99 @@ def handle_preflight():
     # Get the request origin
     origin = request.headers.get('Origin')
     
-    # Check if the origin is allowed
-    if origin and origin in ALLOWED_ORIGINS:
-        response.headers.add('Access-Control-Allow-Origin', origin)
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
-        response.headers.add('Access-Control-Allow-Methods', 'GET,POST,OPTIONS')
-        response.headers.add('Access-Control-Allow-Credentials', 'true')
-        response.headers.add('Access-Control-Max-Age', '3600')  # Cache preflight for 1 hour
-    else:
-        # For development/testing, log the disallowed origin
-        if origin:
-            logger.warning(f"Preflight request from unauthorized origin: {origin}")
-            # For development, we'll allow any vercel.app domain
-            if '.vercel.app' in origin:
-                logger.info(f"Allowing Vercel preview domain: {origin}")
-                response.headers.add('Access-Control-Allow-Origin', origin)
-                response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
-                response.headers.add('Access-Control-Allow-Methods', 'GET,POST,OPTIONS')
-                response.headers.add('Access-Control-Allow-Credentials', 'true')
-                response.headers.add('Access-Control-Max-Age', '3600')
-                
-                # Add this origin to our allowed list for future requests
-                ALLOWED_ORIGINS.append(origin)
-                logger.info(f"Added {origin} to allowed origins list")
-        else:
-            logger.warning("Preflight request without origin header")
+    for header, value in preflight_headers(origin).items():
+        response.headers.add(header, value)
     
     return response
 
-def generate_mock_result():
-    """Generate a mock classification result"""
-    categories = ['recycle', 'compost', 'landfill']
-    random_category = random.choice(categories)
-    
-    details = f"This item appears to be "
-    if random_category == 'recycle':
-        details += "recyclable. It should be placed in your recycling bin."
-    elif random_category == 'compost':
-        details += "compostable. It can be added to your compost pile or green bin."
-    else:
-        details += "non-recyclable trash. It should go in your regular waste bin."
+def preflight_headers(origin):
+    """Get the CORS headers to send in reply to a preflight from origin"""
+    # Check if the origin is allowed
+    if origin and origin in ALLOWED_ORIGINS:
+        return _preflight_allow_headers(origin)
     
+    # For development/testing, log the disallowed origin
+    if origin:
+        logger.warning(f"Preflight request from unauthorized origin: {origin}")
+        # For development, we'll allow any vercel.app domain
+        if '.vercel.app' in origin:
+            logger.info(f"Allowing Vercel preview domain: {origin}")
+            
+            # Add this origin to our allowed list for future requests
+            ALLOWED_ORIGINS.append(origin)
+            logger.info(f"Added {origin} to allowed origins list")
+            return _preflight_allow_headers(origin)
+    else:
+        logger.warning("Preflight request without origin header")
+    return {}
+
+def _preflight_allow_headers(origin):
     return {
-        'category': random_category,
-        'confidence': random.randint(70, 99),
-        'details': details,
-        'tips': [
+        'Access-Control-Allow-Origin': origin,
+        'Access-Control-Allow-Headers': 'Content-Type,Authorization,If-None-Match',
+        'Access-Control-Allow-Methods': 'GET,POST,OPTIONS',
+        'Access-Control-Allow-Credentials': 'true',
+        'Access-Control-Max-Age': '3600'  # Cache preflight for 1 hour
+    }
+
+MOCK_DETAILS = {
+    'recycle': "recyclable. It should be placed in your recycling bin.",
+    'compost': "compostable. It can be added to your compost pile or green bin.",
+    'landfill': "non-recyclable trash. It should go in your regular waste bin."
+}
+
+# Mock results are fixed apart from their confidence, so build and serialize them once
+MOCK_RESULT_TEMPLATES = [
+    fast_json.ResultTemplate({
+        'category': category,
+        'confidence': 0,
+        'details': f"This item appears to be {details}",
+        'tips': (
             "When in doubt, check your local recycling guidelines.",
             "Clean items before recycling to avoid contamination.",
             "Consider reducing waste by using reusable alternatives."
-        ],
+        ),
         'environmental_impact': "By properly disposing of this item, you're helping reduce landfill waste.",
         'buds_reward': 5
-    }
+    }, ('confidence',))
+    for category, details in MOCK_DETAILS.items()
+]
+
+def generate_mock_result():
+    """Generate a mock classification result"""
+    return random.choice(MOCK_RESULT_TEMPLATES).build(confidence=random.randint(70, 99))
+
+def mock_result_body():
+    """A mock classification result as ready-made JSON bytes"""
+    return random.choice(MOCK_RESULT_TEMPLATES).render(confidence=random.randint(70, 99))
+
+def mock_result_response():
+    """Respond with a mock classification result"""
+    return app.response_class(mock_result_body(), mimetype='application/json')
+
+# Warm-up runs in the background once a worker is up (see gunicorn.conf.py),
+# so the first requests do not pay for NumPy/Pillow imports and TLS handshakes
+WARM_UP_ENABLED = os.environ.get('WARM_UP', 'True').lower() == 'true'
+WARM_UP_CONNECT = os.environ.get('WARM_UP_CONNECT', 'True').lower() == 'true'
+
+def warm_up():
+    """Do the one-time setup of lazily loaded modules and upstream sessions; returns seconds per step"""
+    started = time.perf_counter()
+    timings = {}
+    if trash_scanner is not None:
+        timings.update(trash_scanner.warm_up(connect=WARM_UP_CONNECT))
+    if SUPABASE_URL:
+        step_started = time.perf_counter()
+        http_client.get_session(SUPABASE_URL)
+        timings['supabase_session'] = time.perf_counter() - step_started
+    logger.info(f"Warm-up finished in {time.perf_counter() - started:.2f}s: "
+                + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timings.items()))
+    return timings
+
+def start_warm_up():
+    """Run warm_up() on a background thread, unless WARM_UP is off"""
+    if WARM_UP_ENABLED:
+        threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
 
 if __name__ == '__main__':
     # Get port from environment variable or use 5000 as default
@@ -352,4 +998,5 @@ if __name__ == '__main__':
             print(f"{key}: {value}")
     
     # Run the app
+    start_warm_up()
     app.run(host='0.0.0.0', port=port, debug=False) 
\ No newline at end of file
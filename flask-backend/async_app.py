@@ -0,0 +1,782 @@
+"""Async (aiohttp) serving mode for the EcoVision backend.
+
+Serves the same routes and JSON contracts as ``app.py``, but every upstream
+call to Supabase or Gemini is awaited on a single event loop, so one worker
+process can hold hundreds of in-flight upstream requests instead of one per
+thread. Request building and result shaping are shared with ``app.py``.
+
+Run it through gunicorn (see gunicorn.conf.py) with SERVER_MODE=async, or
+locally with ``python async_app.py``.
+"""
+import os
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime
+
+from aiohttp import web, ClientError, ClientSession, ClientTimeout, TCPConnector
+
+import app as flask_app
+import circuit_breaker
+import fast_json
+import http_client
+import jobs
+import metrics
+import rate_limit
+import supabase_batch
+import supabase_cache
+import supabase_stream
+import uploads
+from singleflight import AsyncSingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Largest request body accepted (receipt photos from phone cameras are several MB)
+MAX_REQUEST_BYTES = int(os.environ.get('MAX_REQUEST_BYTES', 16 * 1024 * 1024))
+
+UPSTREAM_SESSION = web.AppKey('upstream_session', ClientSession)
+
+# Concurrent identical uploads share one upstream call
+receipt_flights = AsyncSingleFlight()
+classify_flights = AsyncSingleFlight()
+
+
+def json_response(data, status=200, headers=None):
+    """web.json_response() encoded with fast_json"""
+    return web.Response(body=fast_json.dumps(data), status=status, headers=headers,
+                        content_type='application/json')
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """Answer preflights and add CORS headers the same way flask_cors does"""
+    origin = request.headers.get('Origin')
+    if request.method == 'OPTIONS':
+        response = json_response({'status': 'ok'})
+        response.headers.update(flask_app.preflight_headers(origin))
+        return response
+
+    response = await handler(request)
+    if not response.prepared:
+        _add_cors_headers(request, response)
+    return response
+
+
+def _add_cors_headers(request, response):
+    """CORS headers for an allowed origin; streamed responses need them before prepare()"""
+    origin = request.headers.get('Origin')
+    if origin and origin in flask_app.ALLOWED_ORIGINS:
+        response.headers['Access-Control-Allow-Origin'] = origin
+        response.headers['Access-Control-Expose-Headers'] = 'ETag, Retry-After, Content-Range'
+        vary = response.headers.get('Vary')
+        response.headers['Vary'] = f'{vary}, Origin' if vary else 'Origin'
+
+
+async def test_api(request):
+    """Test endpoint to verify API is working"""
+    origin = request.headers.get('Origin')
+    logger.info(f"Test API called from origin: {origin}")
+
+    response = json_response({
+        'status': 'ok',
+        'message': 'API is working',
+        'timestamp': datetime.now().isoformat(),
+        'origin': origin
+    })
+    if origin and origin in flask_app.ALLOWED_ORIGINS:
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization'
+        response.headers['Access-Control-Allow-Methods'] = 'GET,POST,OPTIONS'
+    else:
+        logger.warning(f"Request from unauthorized origin: {origin}")
+    return response
+
+
+async def process_receipt(request):
+    """Process receipt images using Gemini API"""
+    try:
+        # Reject oversized uploads before reading the body
+        if request.content_length and request.content_length > uploads.MAX_RECEIPT_BYTES:
+            return json_response({'error': 'File too large', 'max_bytes': uploads.MAX_RECEIPT_BYTES}, status=413)
+        limited = await _check_rate_limit(request, 'receipt')
+        if limited:
+            return limited
+        if not request.content_type.startswith('multipart/'):
+            return json_response({'error': 'No file provided'}, status=400)
+
+        # Stream the multipart body into a bounded spool instead of buffering it all
+        reader = await request.multipart()
+        spool = uploads.UploadSpool()
+        handed_off = False
+        try:
+            filename = None
+            async for part in reader:
+                if part.name != 'file':
+                    continue
+                filename = part.filename
+                while True:
+                    chunk = await part.read_chunk(uploads.READ_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    spool.write(chunk)
+                break
+
+            if filename is None:
+                return json_response({'error': 'No file provided'}, status=400)
+            if filename == '':
+                return json_response({'error': 'No file selected'}, status=400)
+
+            logger.info(f"Processing receipt: {filename}")
+
+            # ?mode=job returns a job id at once instead of waiting on Gemini
+            if request.query.get('mode') == 'job' and flask_app.job_queue is not None:
+                return await _submit_job('receipt', spool.rewind().read())
+
+            # Identical uploads in flight at the same time share one Gemini call.
+            # That call can outlive this request if the client goes away, so the
+            # spool is handed over to it rather than closed here
+            def process():
+                nonlocal handed_off
+                handed_off = True
+                return _process_spooled_receipt(request.app, spool)
+
+            with metrics.span('receipt_request'):
+                result, shared = await receipt_flights.do(spool.digest, process)
+        finally:
+            if not handed_off:
+                spool.close()
+        if shared:
+            logger.info("Coalesced duplicate receipt request")
+        return json_response(result)
+    except uploads.UploadTooLarge:
+        return json_response({'error': 'File too large', 'max_bytes': uploads.MAX_RECEIPT_BYTES}, status=413)
+    except Exception as e:
+        logger.error(f"Error processing receipt: {str(e)}")
+        return json_response({'error': 'Failed to process receipt', 'details': str(e)}, status=500)
+
+
+async def _process_spooled_receipt(app, spool):
+    """_process_receipt_data() for an upload spool, closing it when done"""
+    with spool:
+        return await _process_receipt_data(app, spool.rewind())
+
+
+async def _process_receipt_data(app, fileobj):
+    """Send a receipt image to Gemini and build the client result"""
+    # Downsampling is CPU-bound, so keep it off the event loop
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    image = await loop.run_in_executor(None, uploads.downsample_receipt, fileobj)
+    metrics.observe_stage('receipt_downsample', time.perf_counter() - started)
+
+    # Skip the upstream entirely while its circuit is open
+    breaker = flask_app.receipt_breaker
+    if breaker is not None and breaker.is_open():
+        logger.info("Gemini receipt circuit is open, using fallback method")
+        metrics.count('fallbacks', 'receipt_circuit_open')
+        return flask_app.process_receipt_fallback(image)
+
+    async def post():
+        # Build the streamed body per attempt so a hedged retry can send it again
+        gemini_url, body, headers = flask_app.build_receipt_stream_request(image)
+        async with app[UPSTREAM_SESSION].post(gemini_url, data=_async_iter(body), headers=headers) as response:
+            return response.status, await response.read()
+
+    logger.info(f"Sending request to Gemini API ({len(image)} byte image)")
+    started = time.perf_counter()
+    try:
+        async with _upstream_slot():
+            if breaker is None:
+                status, body = await post()
+            else:
+                status, body = await breaker.call_async(
+                    post, is_failure=lambda result: circuit_breaker.is_upstream_failure(result[0]))
+    except circuit_breaker.CircuitOpenError:
+        metrics.count('fallbacks', 'receipt_circuit_open')
+        return flask_app.process_receipt_fallback(image)
+    except rate_limit.SlotTimeout:
+        metrics.count('fallbacks', 'receipt_overloaded')
+        return flask_app.process_receipt_fallback(image)
+    except (ClientError, asyncio.TimeoutError) as e:
+        # The breaker has already counted the failure; the client still gets a result
+        logger.error(f"Gemini API request failed: {str(e)}")
+        metrics.count('upstream_responses', 'gemini_receipt', 'error')
+        metrics.count('fallbacks', 'receipt')
+        return flask_app.process_receipt_fallback(image)
+    finally:
+        metrics.observe_stage('receipt_upstream', time.perf_counter() - started)
+
+    metrics.count('upstream_responses', 'gemini_receipt', str(status))
+    if status != 200:
+        logger.error(f"Gemini API error: {status} - {body.decode('utf-8', 'replace')}")
+
+        # If Gemini API is unavailable, use a fallback method
+        logger.info("Using fallback method for receipt processing")
+        metrics.count('fallbacks', 'receipt')
+        return flask_app.process_receipt_fallback(image)
+
+    return flask_app.build_receipt_result(json.loads(body))
+
+
+def _upstream_slot():
+    """Hold a fair-share upstream slot for the current client, if scheduling is on"""
+    if rate_limit.scheduler is None:
+        return contextlib.nullcontext()
+    return rate_limit.scheduler.slot_async()
+
+
+async def _check_rate_limit(request, route, cost=1):
+    """Charge the caller for upstream work; returns a 429 response if they are over the limit"""
+    client = rate_limit.client_key(request.headers.get('Authorization'), request.remote,
+                                   request.headers.get('X-Forwarded-For'))
+    # Task-local, and copied into the threads classification runs on
+    rate_limit.current_client.set(client)
+    if rate_limit.limiter is None:
+        return None
+    # The shared backend may wait on a file lock, so keep it off the event loop
+    retry_after = await asyncio.to_thread(rate_limit.limiter.check, client, cost)
+    if not retry_after:
+        return None
+    metrics.count('rate_limited', route)
+    header = rate_limit.retry_after_header(retry_after)
+    return json_response({'error': 'Too many requests, please slow down', 'retry_after': int(header)},
+                         status=429, headers={'Retry-After': header})
+
+
+async def _async_iter(chunks):
+    """Adapt a synchronous chunk generator for aiohttp's streaming request body"""
+    for chunk in chunks:
+        yield chunk
+
+
+async def supabase_data(request):
+    """Proxy for Supabase data operations"""
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if not data:
+            return json_response({'error': 'No data provided'}, status=400)
+
+        # Required fields
+        if 'table' not in data:
+            return json_response({'error': 'Table name is required'}, status=400)
+
+        table = data['table']
+        operation = data.get('operation', 'select')
+        query_params = data.get('params', {})
+        auth_token = request.headers.get('Authorization')
+
+        logger.info(f"Supabase operation: {operation} on table: {table}")
+
+        if operation not in flask_app.SUPABASE_METHODS:
+            return json_response({'error': 'Invalid operation'}, status=400)
+
+        # Large uncached selects go straight through to the client, unparsed
+        if _passthrough_select(request, table, operation):
+            return await _stream_supabase(request, table, query_params, auth_token)
+
+        status, body, etag = await _fetch_supabase(
+            request.app, table, operation, query_params, data.get('data', {}), auth_token)
+        if etag is not None:
+            return _select_response(request, body, status, etag)
+
+        # Return the response from Supabase as-is; an empty write response becomes {}
+        return web.Response(body=body or b'{}', status=status, content_type='application/json')
+    except Exception as e:
+        logger.error(f"Error in Supabase operation: {str(e)}")
+        return json_response({'error': 'Failed to perform Supabase operation'}, status=500)
+
+
+async def _fetch_supabase(app, table, operation, query_params, payload, auth_token, prefer=None):
+    """Run one PostgREST operation through the select cache, like app.fetch_supabase"""
+    # Serve repeated selects from memory
+    select_cache = supabase_cache.select_cache
+    if operation == 'select':
+        key = supabase_cache.cache_key(table, query_params, auth_token)
+        cached = select_cache.get(key) if select_cache.ttl_for(table) else None
+        metrics.count('supabase_cache', 'hit' if cached is not None else 'miss')
+        if cached is not None:
+            return cached.status, cached.body, cached.etag
+        generation = select_cache.generation(table)
+
+    method, url, request_kwargs = flask_app.build_supabase_request(
+        table, operation, query_params, payload, auth_token)
+    if prefer:
+        request_kwargs['headers']['Prefer'] = prefer
+    # requests silently drops None headers and stringifies params; aiohttp does neither
+    request_kwargs['headers'] = {k: v for k, v in request_kwargs['headers'].items() if v is not None}
+    if 'params' in request_kwargs:
+        request_kwargs['params'] = _query_params(request_kwargs['params'])
+
+    session = app[UPSTREAM_SESSION]
+    started = time.perf_counter()
+    try:
+        async with session.request(method, url, **request_kwargs) as response:
+            body = await response.read()
+            status = response.status
+    except Exception:
+        metrics.count('upstream_responses', 'supabase', 'error')
+        raise
+    finally:
+        metrics.observe_stage('supabase_upstream', time.perf_counter() - started)
+    metrics.count('upstream_responses', 'supabase', str(status))
+
+    if operation == 'select':
+        entry = select_cache.put(key, generation, body or b'{}', status)
+        return entry.status, entry.body, entry.etag
+
+    # Writes make cached selects of the table stale
+    select_cache.invalidate(table)
+    return status, body, None
+
+
+def _passthrough_select(request, table, operation):
+    """Whether a proxied operation can be streamed, like flask_app.passthrough_select"""
+    return (supabase_stream.SUPABASE_PASSTHROUGH_ENABLED and operation == 'select'
+            and not supabase_cache.select_cache.ttl_for(table) and not request.headers.get('If-None-Match'))
+
+
+async def _stream_supabase(request, table, query_params, auth_token):
+    """Relay a PostgREST select to the client chunk by chunk, like flask_app.stream_supabase"""
+    method, url, request_kwargs = flask_app.build_supabase_request(table, 'select', query_params, None, auth_token)
+    accept_encoding = request.headers.get('Accept-Encoding')
+    headers = {k: v for k, v in request_kwargs['headers'].items() if v is not None}
+    headers['Accept-Encoding'] = supabase_stream.upstream_accept_encoding(accept_encoding)
+
+    session = request.app[UPSTREAM_SESSION]
+    started = time.perf_counter()
+    try:
+        upstream = await session.request(method, url, headers=headers,
+                                         params=_query_params(request_kwargs['params']), auto_decompress=False)
+    except Exception:
+        metrics.count('upstream_responses', 'supabase', 'error')
+        raise
+    finally:
+        metrics.observe_stage('supabase_upstream', time.perf_counter() - started)
+    metrics.count('upstream_responses', 'supabase', str(upstream.status))
+
+    async with upstream:
+        response_headers, decode = supabase_stream.response_headers(upstream.headers, accept_encoding)
+        decoder = None
+        if decode:
+            # Upstream ignored our Accept-Encoding
+            decoder = supabase_stream.content_decoder(upstream.headers.get('Content-Encoding', '').strip().lower())
+            if decoder is None:
+                return json_response({'error': 'Unsupported upstream content encoding'}, status=502)
+        metrics.count('supabase_passthrough', response_headers.get('Content-Encoding', 'identity'))
+        response = web.StreamResponse(status=upstream.status, headers=response_headers)
+        _add_cors_headers(request, response)
+        await response.prepare(request)
+        async for chunk in upstream.content.iter_chunked(supabase_stream.PASSTHROUGH_CHUNK_BYTES):
+            await response.write(decoder.decompress(chunk) if decoder else chunk)
+        if decoder:
+            await response.write(decoder.flush())
+        await response.write_eof()
+        return response
+
+
+def _select_response(request, body, status, etag):
+    """Send a select body as-is, or 304 if the client already has this version"""
+    if status == 200 and supabase_cache.etag_matches(request.headers.get('If-None-Match'), etag):
+        return web.Response(status=304, headers={'ETag': etag})
+    return web.Response(body=body, status=status, content_type='application/json', headers={'ETag': etag})
+
+
+async def supabase_batch_data(request):
+    """Run an ordered list of Supabase operations in one request"""
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        operations = (data or {}).get('operations')
+        if not isinstance(operations, list) or not operations:
+            return json_response({'error': 'Expected a non-empty "operations" array'}, status=400)
+        if len(operations) > supabase_batch.MAX_BATCH_OPERATIONS:
+            return json_response(
+                {'error': f'At most {supabase_batch.MAX_BATCH_OPERATIONS} operations per batch'}, status=400)
+
+        auth_token = request.headers.get('Authorization')
+        phases, errors = supabase_batch.plan_batch(
+            operations, flask_app.SUPABASE_METHODS, parallel=data.get('parallel') is True)
+        logger.info(f"Supabase batch: {len(operations)} operations in "
+                    f"{supabase_batch.count_steps(phases)} upstream calls in {len(phases)} phases")
+
+        limit = asyncio.Semaphore(supabase_batch.BATCH_CONCURRENCY)
+
+        async def run_lane(steps):
+            async with limit:
+                results = []
+                for step in steps:
+                    results.extend(await _run_supabase_step(request.app, step, auth_token))
+                return results
+
+        step_results = []
+        for lanes in phases:
+            for results in await asyncio.gather(*(run_lane(steps) for steps in lanes)):
+                step_results.extend(results)
+        return json_response({'results': supabase_batch.ordered_results(len(operations), errors, step_results)})
+    except Exception as e:
+        logger.error(f"Error in Supabase batch: {str(e)}")
+        return json_response({'error': 'Failed to perform Supabase operation'}, status=500)
+
+
+async def _run_supabase_step(app, step, auth_token):
+    """Run one planned batch step and return per-operation results"""
+    try:
+        status, body, _ = await _fetch_supabase(
+            app, step.table, step.operation, step.params, supabase_batch.step_payload(step), auth_token,
+            prefer=supabase_batch.step_prefer(step))
+    except Exception as e:
+        logger.error(f"Error in Supabase batch operation on {step.table}: {str(e)}")
+        return [supabase_batch.error_result(index, 'Failed to perform Supabase operation')
+                for index in step.indexes]
+    return supabase_batch.split_results(step, status, body)
+
+
+def _query_params(params):
+    """Convert JSON query params to the strings aiohttp expects, like requests does"""
+    converted = []
+    for key, value in (params or {}).items():
+        if value is None:
+            continue
+        values = value if isinstance(value, list) else [value]
+        converted.extend((key, str(item)) for item in values)
+    return converted
+
+
+async def classify_trash(request):
+    """Classify trash images"""
+    try:
+        limited = await _check_rate_limit(request, 'classify')
+        if limited:
+            return limited
+
+        # The Content-Type picks the format: raw image bytes, multipart, or base64 in JSON
+        key = None
+        if request.content_type in flask_app.BINARY_IMAGE_TYPES or request.content_type == 'multipart/form-data':
+            try:
+                key, image_bytes = await _read_image_upload(request)
+            except uploads.UploadTooLarge:
+                return json_response({'error': 'File too large', 'max_bytes': uploads.MAX_IMAGE_BYTES}, status=413)
+            except ValueError as e:
+                return json_response({'error': str(e)}, status=400)
+            image_data = None
+            logger.info(f"Received {len(image_bytes)} byte image as {request.content_type}")
+        else:
+            try:
+                data = await request.json()
+            except ValueError:
+                data = None
+            if not data or 'image' not in data:
+                if request.content_type != 'application/json':
+                    return json_response(
+                        {'error': 'Unsupported image upload format', 'accepted': flask_app.ACCEPTED_SCAN_TYPES},
+                        status=415, headers={'Accept-Post': flask_app.ACCEPTED_SCAN_TYPES})
+                return json_response({'error': 'No image data provided'}, status=400)
+            image_data = data['image']
+            logger.info(f"Received image data of length: {len(image_data)}")
+
+        # ?mode=stream sends each field as a Server-Sent Event as soon as Gemini writes it
+        streaming = request.query.get('mode') == 'stream'
+        if not flask_app.scanner_enabled():
+            if streaming:
+                return await _event_stream(request, _single_event('result', flask_app.generate_mock_result()))
+            return web.Response(body=flask_app.mock_result_body(), content_type='application/json')
+
+        if image_data is not None:
+            try:
+                image_bytes = flask_app.decode_image_data(image_data)
+            except ValueError:
+                return json_response({'error': 'Invalid image data'}, status=400)
+
+        # ?mode=job returns a job id at once instead of waiting on Gemini
+        if request.query.get('mode') == 'job' and flask_app.job_queue is not None:
+            return await _submit_job('scan', image_bytes)
+
+        if streaming:
+            # Not coalesced: each stream needs its own partial fields as they arrive
+            return await _event_stream(request, flask_app.trash_scanner.classify_trash_stream_async(
+                request.app[UPSTREAM_SESSION], image_bytes))
+
+        async def classify():
+            return (await _classify_images(request.app, [image_bytes]))[0]
+
+        # Identical images in flight at the same time share one classification
+        key = key or hashlib.sha256(image_bytes).hexdigest()
+        with metrics.span('classify_request'):
+            result, shared = await classify_flights.do(key, classify)
+        if shared:
+            logger.info("Coalesced duplicate classification request")
+        if 'error' in result:
+            return json_response({'error': 'Failed to classify trash', 'details': result['error']}, status=500)
+        return json_response(result['result'])
+    except Exception as e:
+        logger.error(f"Error classifying trash: {str(e)}")
+        return json_response({'error': 'Failed to classify trash'}, status=500)
+
+
+async def _event_stream(request, events):
+    """Send (event, data) pairs from an async iterator as Server-Sent Events"""
+    response = web.StreamResponse(headers=dict(flask_app.SSE_HEADERS, **{'Content-Type': 'text/event-stream'}))
+    _add_cors_headers(request, response)
+    await response.prepare(request)
+    try:
+        async for event, data in events:
+            await response.write(jobs.format_event(event, data).encode('utf-8'))
+    finally:
+        # Releases the upstream connection and slot if the client went away
+        await events.aclose()
+    return response
+
+
+async def _single_event(event, data):
+    """An async iterator of one (event, data) pair"""
+    yield event, data
+
+
+async def _classify_images(app, images):
+    """Classify raw image bytes like flask_app.classify_images, awaiting Gemini on the event loop"""
+    session = app[UPSTREAM_SESSION]
+    if len(images) == 1:
+        return [{'result': await flask_app.trash_scanner.classify_trash_async(session, images[0])}]
+    return [
+        {key: value for key, value in item.items() if key != 'image'}
+        for item in await flask_app.trash_scanner.classify_many_async(session, images)
+    ]
+
+
+async def _read_image_upload(request):
+    """Read a raw or multipart image upload chunk by chunk, like flask_app.read_image_upload"""
+    if request.content_length and request.content_length > uploads.MAX_IMAGE_BYTES:
+        raise uploads.UploadTooLarge(f'Upload exceeds {uploads.MAX_IMAGE_BYTES} bytes')
+    buffer = uploads.UploadBuffer(uploads.MAX_IMAGE_BYTES)
+    if request.content_type == 'multipart/form-data':
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name in ('image', 'file'):
+                while True:
+                    chunk = await part.read_chunk(uploads.READ_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    buffer.write(chunk)
+                break
+        else:
+            raise ValueError('No image file provided')
+    else:
+        async for chunk in request.content.iter_chunked(uploads.READ_CHUNK_BYTES):
+            buffer.write(chunk)
+    image_bytes = buffer.getvalue()
+    if not image_bytes:
+        raise ValueError('Image data is empty')
+    return buffer.digest, image_bytes
+
+
+async def _read_batch_uploads(request):
+    """Read the "images" parts of a multipart batch chunk by chunk, like flask_app.read_batch_uploads.
+
+    Stops one image past MAX_BATCH_IMAGES, which is enough to refuse the batch.
+    """
+    images = []
+    remaining = flask_app.MAX_BATCH_BYTES
+    reader = await request.multipart()
+    async for part in reader:
+        # Only file parts count, as with request.files
+        if part.name != 'images' or part.filename is None:
+            continue
+        buffer = uploads.UploadBuffer(min(uploads.MAX_IMAGE_BYTES, remaining))
+        while True:
+            chunk = await part.read_chunk(uploads.READ_CHUNK_BYTES)
+            if not chunk:
+                break
+            buffer.write(chunk)
+        image = buffer.getvalue()
+        remaining -= len(image)
+        images.append(image)
+        if len(images) > flask_app.MAX_BATCH_IMAGES:
+            break
+    return images
+
+
+def _batch_too_large():
+    """413 reply for a batch over the size limits, like flask_app.batch_too_large"""
+    return json_response({'error': 'File too large', 'max_bytes': uploads.MAX_IMAGE_BYTES,
+                          'max_batch_bytes': flask_app.MAX_BATCH_BYTES}, status=413)
+
+
+async def classify_trash_batch(request):
+    """Classify several trash images in one request"""
+    try:
+        # Reject oversized batches before reading the body
+        if request.content_length and request.content_length > flask_app.MAX_BATCH_BYTES:
+            return _batch_too_large()
+
+        # Accept either multipart uploads or a JSON array of base64 strings
+        if request.content_type.startswith('multipart/'):
+            try:
+                entries = await _read_batch_uploads(request)
+            except uploads.UploadTooLarge:
+                return _batch_too_large()
+        else:
+            try:
+                data = await request.json()
+            except ValueError:
+                data = None
+            entries = (data or {}).get('images')
+            if not isinstance(entries, list):
+                return json_response({'error': 'Expected an "images" array'}, status=400)
+
+        if not entries:
+            return json_response({'error': 'No images provided'}, status=400)
+        if len(entries) > flask_app.MAX_BATCH_IMAGES:
+            return json_response({'error': f'At most {flask_app.MAX_BATCH_IMAGES} images per batch'}, status=400)
+
+        # Each image is its own upstream call
+        limited = await _check_rate_limit(request, 'classify_batch', cost=len(entries))
+        if limited:
+            return limited
+
+        logger.info(f"Classifying batch of {len(entries)} images")
+        # Decoding base64 is CPU work; the Gemini calls are awaited here
+        results, images, indexes = await asyncio.to_thread(flask_app.decode_batch, entries)
+        if flask_app.scanner_enabled():
+            classified = await _classify_images(request.app, images)
+        else:
+            classified = [{'result': flask_app.generate_mock_result()} for _ in images]
+        return json_response({'results': flask_app.merge_batch_results(results, indexes, classified)})
+    except Exception as e:
+        logger.error(f"Error classifying trash batch: {str(e)}")
+        return json_response({'error': 'Failed to classify trash'}, status=500)
+
+
+async def _submit_job(kind, payload):
+    """Queue a job and answer 202 with where to poll for its result"""
+    loop = asyncio.get_running_loop()
+    try:
+        # The insert writes the whole payload to SQLite, so keep it off the event loop
+        job_id = await loop.run_in_executor(None, flask_app.job_queue.submit, kind, payload,
+                                            rate_limit.current_client.get())
+    except jobs.QueueFull:
+        return json_response({'error': 'Too many queued jobs, try again later'}, status=503,
+                             headers={'Retry-After': '5'})
+    links = flask_app.job_links(job_id)
+    return json_response(links, status=202, headers={'Location': links['status_url']})
+
+
+async def _get_job(job_id):
+    if flask_app.job_queue is None:
+        return None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, flask_app.job_queue.get, job_id)
+
+
+async def job_status(request):
+    """Current status of a background job, with its result once finished"""
+    job = await _get_job(request.match_info['job_id'])
+    if job is None:
+        return json_response({'error': 'Job not found'}, status=404)
+    return json_response(job)
+
+
+async def job_events(request):
+    """Server-Sent Events stream of a background job's status changes"""
+    job_id = request.match_info['job_id']
+    job = await _get_job(job_id)
+    if job is None:
+        return json_response({'error': 'Job not found'}, status=404)
+
+    # Worker threads in this process wake the stream at once; other
+    # processes' changes are picked up by polling
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+
+    def listener(changed_id):
+        if changed_id == job_id:
+            loop.call_soon_threadsafe(changed.set)
+
+    response = web.StreamResponse(headers=dict(flask_app.SSE_HEADERS, **{'Content-Type': 'text/event-stream'}))
+    _add_cors_headers(request, response)
+    await response.prepare(request)
+    flask_app.job_queue.add_listener(listener)
+    try:
+        await response.write(b'retry: 2000\n\n')
+        deadline = time.monotonic() + jobs.JOB_EVENTS_TIMEOUT
+        status = None
+        idle_since = time.monotonic()
+        while job is not None and time.monotonic() < deadline:
+            if job['status'] in jobs.FINISHED:
+                await response.write(jobs.format_event('done', job).encode('utf-8'))
+                break
+            if job['status'] != status:
+                status = job['status']
+                await response.write(jobs.format_event('status', {'id': job_id, 'status': status}).encode('utf-8'))
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since >= jobs.JOB_HEARTBEAT_SECONDS:
+                await response.write(b': keep-alive\n\n')
+                idle_since = time.monotonic()
+            try:
+                await asyncio.wait_for(changed.wait(), jobs.JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            changed.clear()
+            job = await _get_job(job_id)
+    finally:
+        flask_app.job_queue.remove_listener(listener)
+    return response
+
+
+async def metrics_endpoint(request):
+    """Prometheus metrics: per-stage latency histograms and event counters"""
+    if not metrics.METRICS_ENABLED:
+        return json_response({'error': 'Metrics are disabled'}, status=404)
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def _upstream_session(app):
+    """Keep one pooled client session open for the lifetime of the worker"""
+    connector = TCPConnector(
+        limit=int(os.environ.get('UPSTREAM_ASYNC_LIMIT', 512)),
+        limit_per_host=int(os.environ.get('UPSTREAM_ASYNC_LIMIT_PER_HOST', 256)),
+        ttl_dns_cache=300,
+        keepalive_timeout=30
+    )
+    timeout = ClientTimeout(
+        sock_connect=http_client.CONNECT_TIMEOUT,
+        sock_read=http_client.READ_TIMEOUT
+    )
+    app[UPSTREAM_SESSION] = ClientSession(connector=connector, timeout=timeout)
+    yield
+    await app[UPSTREAM_SESSION].close()
+
+
+async def create_app():
+    """Build the aiohttp application (used as the gunicorn app factory)"""
+    app = web.Application(middlewares=[cors_middleware], client_max_size=MAX_REQUEST_BYTES)
+    app.cleanup_ctx.append(_upstream_session)
+
+    for path, handler, methods in (
+        ('/api/test', test_api, ('GET',)),
+        ('/api/process-receipt', process_receipt, ('POST',)),
+        ('/api/supabase/data', supabase_data, ('POST',)),
+        ('/api/supabase/batch', supabase_batch_data, ('POST',)),
+        ('/api/classify-trash', classify_trash, ('POST',)),
+        ('/api/classify-trash/batch', classify_trash_batch, ('POST',)),
+        ('/api/jobs/{job_id}', job_status, ('GET',)),
+        ('/api/jobs/{job_id}/events', job_events, ('GET',)),
+        ('/metrics', metrics_endpoint, ('GET',)),
+    ):
+        for method in methods + ('OPTIONS',):
+            app.router.add_route(method, path, handler)
+    return app
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    port = int(os.environ.get('PORT', 5000))
+    print(f"Starting async application on port {port}")
+    web.run_app(create_app(), host='0.0.0.0', port=port)
@@ -0,0 +1,605 @@
+"""Reproducible benchmarks for the classification and proxy hot paths.
+
+Starts a local stub server that stands in for Gemini (classification and
+receipts) and Supabase's PostgREST, with configurable latency and error
+rate, then drives:
+
+  * trash_scanner.preprocess_image, classify_trash_offline and
+    classify_trash (cold and cached) directly
+  * the Flask routes /api/classify-trash (blocking and ?mode=stream), /api/process-receipt and
+    /api/supabase/data through the WSGI test client
+
+using the sample images in src/images/ as the fixture corpus. Each case
+reports throughput, latency percentiles, errors, peak RSS and the
+per-stage breakdown from metrics.py. Results can be written as JSON and
+compared against an earlier run:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+
+--startup instead measures cold start: the import cost of each module the
+servers load (from ``python -X importtime`` in fresh interpreters) and the
+time each warm-up step takes.
+"""
+import io
+import os
+import math
+import sys
+import glob
+import json
+import time
+import random
+import gzip
+import base64
+import argparse
+import platform
+import resource
+import threading
+import contextlib
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BACKEND = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BACKEND)
+DEFAULT_IMAGES = os.path.join(ROOT, 'src', 'images', '*')
+
+CASES = (
+    'preprocess_image',
+    'classify_trash_offline',
+    'classify_trash',
+    'classify_trash_cached',
+    'route_classify_trash',
+    'route_classify_stream',
+    'route_process_receipt',
+    'route_supabase_select',
+    'route_supabase_history',
+    'route_supabase_insert',
+    'route_supabase_batch',
+)
+
+# Route cases that must miss the classification cache
+COLD_ROUTE_CASES = ('route_classify_trash', 'route_classify_stream')
+# The stub streams classifications in this many Server-Sent Events
+STUB_STREAM_EVENTS = 4
+
+# Gemini bills each image at a flat token count; text is roughly four characters a token
+STUB_IMAGE_TOKENS = 258
+
+# Entry points profiled by --startup
+STARTUP_MODULES = ('trash_scanner', 'app', 'async_app')
+
+STUB_CLASSIFICATION = {
+    "category": "recycle",
+    "confidence": 88,
+    "details": "Stub classification for benchmarking.",
+    "environmental_impact": "None, this is a benchmark.",
+    "tips": ["Rinse before recycling", "Check local guidelines"],
+    "buds_reward": 12
+}
+STUB_RECEIPT_TEXT = '\n'.join(
+    ['STUB GROCERY', 'ORGANIC BANANAS 012345678901 2.49 F', '2 x Plastic Water Bottles 7.98',
+     'GROUND BEEF 2 @ 5.99 11.98 F', 'Recycled Paper Towels $2.99 T'] * 40
+    + ['SUBTOTAL 1177.60', 'TAX 12.00', 'TOTAL 1189.60']
+)
+STUB_ROWS = [
+    {'id': i, 'user_id': 'user_bench', 'action': 'Recycled a bottle', 'buds': 10} for i in range(50)
+]
+
+# A long scan history from an uncached table, served gzipped when the client accepts it
+STUB_HISTORY_TABLE = 'trash_scans'
+STUB_HISTORY_BODY = json.dumps([
+    {'id': i, 'user_id': 'user_bench', 'category': ('recycle', 'compost', 'landfill')[i % 3],
+     'confidence': 50 + i % 50, 'details': 'Stub scan details for benchmarking. ' * 4,
+     'buds_reward': 5 + i % 15, 'created_at': '2025-03-01T12:00:00+00:00'}
+    for i in range(5000)
+]).encode('utf-8')
+STUB_HISTORY_GZIP = gzip.compress(STUB_HISTORY_BODY, compresslevel=6)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Minimal Gemini + PostgREST stand-in with injected latency and errors"""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this, Nagle's algorithm
+    # and delayed ACKs add ~40ms to small responses on a keep-alive connection
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _delay_or_fail(self, latency=None):
+        server = self.server
+        latency = server.latency if latency is None else latency
+        if latency:
+            time.sleep(latency)
+        with server.lock:
+            failed = server.rng.random() < server.error_rate
+        if failed:
+            self._send(503, {'error': 'stub failure'})
+        return failed
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_history(self):
+        headers = {'Content-Type': 'application/json; charset=utf-8', 'Content-Range': '0-4999/*'}
+        body = STUB_HISTORY_BODY
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = STUB_HISTORY_GZIP
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, texts, gap, usage):
+        """Send each text as a streamGenerateContent?alt=sse event, gap seconds apart"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for index, text in enumerate(texts):
+                if index:
+                    time.sleep(gap)
+                chunk = {'candidates': [{'content': {'parts': [{'text': text}]}}]}
+                if index == len(texts) - 1:
+                    # Like Gemini, the last event carries the call's totals
+                    chunk['usageMetadata'] = usage
+                event = b'data: ' + json.dumps(chunk).encode()
+                event += b'\r\n\r\n'
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(event), event))
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading once it had what it needed
+            self.close_connection = True
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunks.append(self.rfile.read(size + 2)[:size])
+                if size == 0:
+                    return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_GET(self):
+        if self._delay_or_fail():
+            return
+        if self.path.startswith(f'/rest/v1/{STUB_HISTORY_TABLE}'):
+            self._send_history()
+        elif self.path.startswith('/rest/v1/'):
+            self._send(200, STUB_ROWS)
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        body = self._read_body()
+        gemini = ':generateContent' in self.path or ':streamGenerateContent' in self.path
+        parts = json.loads(body)['contents'][0]['parts'] if gemini else []
+        if ':streamGenerateContent' in self.path:
+            # The same total latency as generateContent, spread over the events
+            gap = self.server.latency / STUB_STREAM_EVENTS
+            if self._delay_or_fail(gap):
+                return
+            text = json.dumps(STUB_CLASSIFICATION)
+            size = math.ceil(len(text) / STUB_STREAM_EVENTS)
+            self._send_stream([text[i:i + size] for i in range(0, len(text), size)], gap, stub_usage(parts, text))
+            return
+        if self._delay_or_fail():
+            return
+        if ':generateContent' in self.path:
+            images = sum(1 for part in parts if 'inline_data' in part)
+            if images > 1:
+                # A micro-batched request gets one labelled object per image
+                text = json.dumps([dict(STUB_CLASSIFICATION, image=n) for n in range(1, images + 1)])
+            else:
+                text = json.dumps(STUB_CLASSIFICATION)
+            self._send(200, {'candidates': [{'content': {'parts': [{'text': text}]}}],
+                             'usageMetadata': stub_usage(parts, text)})
+        elif self.path.startswith('/v1/receipt'):
+            self._send(200, {'text': STUB_RECEIPT_TEXT})
+        elif self.path.startswith('/rest/v1/'):
+            rows = []
+            if 'return=representation' in self.headers.get('Prefer', ''):
+                rows = json.loads(body)
+                rows = rows if isinstance(rows, list) else [rows]
+            self._send(201, rows)
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def _no_content(self):
+        self._read_body()
+        if self._delay_or_fail():
+            return
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    # PostgREST answers updates and deletes without a representation
+    do_PATCH = _no_content
+    do_DELETE = _no_content
+
+
+def stub_usage(parts, reply):
+    """A usageMetadata estimate for a request's parts and the stub's reply text"""
+    prompt = sum(STUB_IMAGE_TOKENS if 'inline_data' in part else len(part.get('text', '')) // 4 for part in parts)
+    output = len(reply) // 4
+    return {'promptTokenCount': prompt, 'candidatesTokenCount': output, 'totalTokenCount': prompt + output}
+
+
+def start_stub_server(latency_ms, error_rate, seed):
+    """Start the stub upstream on a free local port; returns the server"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency_ms / 1000.0
+    server.error_rate = error_rate
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure_environment(stub_url):
+    """Point every upstream at the stub before app/trash_scanner are imported"""
+    os.environ['GEMINI_API_KEY'] = 'benchmark-key'
+    os.environ['VITE_GEMINI_API_KEY'] = 'benchmark-key'
+    os.environ['USE_MOCK_RESPONSE'] = 'False'
+    os.environ['GEMINI_API_BASE_URL'] = stub_url
+    os.environ['GEMINI_RECEIPT_URL'] = f'{stub_url}/v1/receipt'
+    os.environ['SUPABASE_PROJECT_URL'] = stub_url
+    os.environ['SUPABASE_API_KEY'] = 'benchmark-key'
+    # Keep the benchmark independent of any on-disk cache from earlier runs
+    os.environ.pop('TRASH_SCANNER_CACHE_DB', None)
+    # Every benchmark request comes from one client, which the per-client
+    # bucket would throttle; set RATE_LIMIT=True to measure with it on
+    os.environ.setdefault('RATE_LIMIT', 'False')
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_case(name, operation, inputs, iterations, concurrency, warmup, metrics):
+    """Run operation over the inputs and collect latency and throughput stats"""
+    for index in range(warmup):
+        operation(inputs[index % len(inputs)])
+    metrics.REGISTRY.reset()
+
+    latencies = [0.0] * iterations
+    errors = 0
+    errors_lock = threading.Lock()
+
+    def timed(index):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            ok = operation(inputs[index % len(inputs)])
+        except Exception:
+            ok = False
+        latencies[index] = time.perf_counter() - started
+        if ok is False:
+            with errors_lock:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(iterations)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'name': name,
+        'iterations': iterations,
+        'concurrency': concurrency,
+        'errors': errors,
+        'elapsed_s': round(elapsed, 4),
+        'throughput_per_s': round(iterations / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'mean': round(1000 * sum(latencies) / len(latencies), 3),
+            'p50': round(1000 * percentile(latencies, 0.50), 3),
+            'p90': round(1000 * percentile(latencies, 0.90), 3),
+            'p99': round(1000 * percentile(latencies, 0.99), 3),
+            'max': round(1000 * latencies[-1], 3),
+        },
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'stages': metrics.snapshot()['stages'],
+    }
+
+
+def build_cases(app_module, trash_scanner, images):
+    """Map case names to (operation, inputs) pairs"""
+    image_bytes = []
+    for path in images:
+        with open(path, 'rb') as image_file:
+            image_bytes.append(image_file.read())
+    data_uris = ['data:image/jpeg;base64,' + base64.b64encode(data).decode('ascii') for data in image_bytes]
+    client_local = threading.local()
+
+    def client():
+        test_client = getattr(client_local, 'client', None)
+        if test_client is None:
+            test_client = client_local.client = app_module.app.test_client()
+        return test_client
+
+    def classify_cold(data):
+        return trash_scanner.classify_trash(data, use_cache=False)['category'] != 'unknown'
+
+    def classify_cached(data):
+        return trash_scanner.classify_trash(data)['category'] != 'unknown'
+
+    def route_classify(data_uri):
+        return client().post('/api/classify-trash', json={'image': data_uri}).status_code == 200
+
+    def route_classify_stream(data_uri):
+        # Time to the first usable field, not to the end of the stream
+        response = client().post('/api/classify-trash?mode=stream', json={'image': data_uri}, buffered=False)
+        try:
+            return any(chunk.startswith(b'event: partial') for chunk in response.response)
+        finally:
+            response.close()
+
+    def route_receipt(data):
+        response = client().post('/api/process-receipt', data={'file': (io.BytesIO(data), 'receipt.jpg')},
+                                 content_type='multipart/form-data')
+        return response.status_code == 200
+
+    def route_select(_):
+        response = client().post('/api/supabase/data', json={
+            'table': 'eco_actions', 'operation': 'select',
+            'params': {'select': '*', 'user_id': 'eq.user_bench'}})
+        return response.status_code == 200
+
+    def route_history(_):
+        # A browser-like client that accepts gzip; the proxy should not have to inflate it
+        response = client().post('/api/supabase/data', headers={'Accept-Encoding': 'gzip, br'}, json={
+            'table': STUB_HISTORY_TABLE, 'operation': 'select',
+            'params': {'select': '*', 'user_id': 'eq.user_bench', 'order': 'created_at.desc'}})
+        return response.status_code == 200 and len(response.get_data()) > 0
+
+    def route_insert(_):
+        response = client().post('/api/supabase/data', json={
+            'table': 'eco_actions', 'operation': 'insert',
+            'data': {'user_id': 'user_bench', 'action': 'Composted', 'buds': 15}})
+        return response.status_code == 201
+
+    # A receipt save: ten item rows, the wallet update and a stats update in one request
+    receipt_save = [
+        {'table': 'receipt_items', 'operation': 'insert',
+         'data': {'receipt_id': 1, 'name': f'Item {i}', 'price': 1.99, 'is_eco_friendly': i % 2 == 0}}
+        for i in range(10)
+    ] + [
+        {'table': 'users', 'operation': 'update', 'params': {'id': 'eq.user_bench'}, 'data': {'buds': 120}},
+        {'table': 'user_stats', 'operation': 'update', 'params': {'user_id': 'eq.user_bench'},
+         'data': {'receipts_scanned': 4}},
+    ]
+
+    def route_batch(_):
+        response = client().post('/api/supabase/batch', json={'operations': receipt_save})
+        return response.status_code == 200 and all('error' not in r for r in response.get_json()['results'])
+
+    return {
+        'preprocess_image': (trash_scanner.preprocess_image, image_bytes),
+        'classify_trash_offline': (trash_scanner.classify_trash_offline, image_bytes),
+        'classify_trash': (classify_cold, image_bytes),
+        'classify_trash_cached': (classify_cached, image_bytes),
+        'route_classify_trash': (route_classify, data_uris),
+        'route_classify_stream': (route_classify_stream, data_uris),
+        'route_process_receipt': (route_receipt, image_bytes),
+        'route_supabase_select': (route_select, [None]),
+        'route_supabase_history': (route_history, [None]),
+        'route_supabase_insert': (route_insert, [None]),
+        'route_supabase_batch': (route_batch, [None]),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(results, baseline):
+    """Print throughput and p50/p99 changes relative to a baseline run"""
+    previous = {case['name']: case for case in baseline.get('results', [])}
+    print(f"\nCompared with {baseline.get('meta', {}).get('commit') or 'baseline'}:")
+    for case in results:
+        before = previous.get(case['name'])
+        if before is None:
+            continue
+        changes = []
+        for label, now, then in (
+            ('throughput', case['throughput_per_s'], before['throughput_per_s']),
+            ('p50', case['latency_ms']['p50'], before['latency_ms']['p50']),
+            ('p99', case['latency_ms']['p99'], before['latency_ms']['p99']),
+        ):
+            if then:
+                changes.append(f"{label} {100 * (now - then) / then:+.1f}%")
+        print(f"  {case['name']:<24} {', '.join(changes)}")
+
+
+def run_fresh(args):
+    """Run the Python interpreter in a new process from the backend directory"""
+    env = dict(os.environ)
+    # trash_scanner lives at the repository root
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    return subprocess.run([sys.executable, *args], cwd=BACKEND, env=env,
+                          capture_output=True, text=True, check=True)
+
+
+def parse_importtime(output, module):
+    """Cost of importing module and each of its direct imports, from -X importtime output"""
+    children = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if depth == 1:
+            # -X importtime reports a module after everything it imported
+            children[name] = int(cumulative_us) / 1000
+        elif depth == 0:
+            if name == module:
+                return {'total_ms': int(cumulative_us) / 1000, 'self_ms': int(self_us) / 1000,
+                        'modules': children}
+            children = {}
+    raise ValueError(f'{module} not found in -X importtime output')
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def profile_startup(runs, top):
+    """Median import costs per entry point and warm-up step timings over fresh interpreters"""
+    report = {}
+    for module in STARTUP_MODULES:
+        samples = [parse_importtime(run_fresh(['-X', 'importtime', '-c', f'import {module}']).stderr, module)
+                   for _ in range(runs)]
+        modules = {name: round(median([sample['modules'].get(name, 0.0) for sample in samples]), 2)
+                   for name in samples[0]['modules']}
+        report[module] = {
+            'total_ms': round(median([sample['total_ms'] for sample in samples]), 2),
+            'self_ms': round(median([sample['self_ms'] for sample in samples]), 2),
+            'modules': dict(sorted(modules.items(), key=lambda item: item[1], reverse=True)[:top]),
+        }
+    warm_up = [json.loads(run_fresh(['-c', 'import json, app; print(json.dumps(app.warm_up()))'])
+                          .stdout.splitlines()[-1]) for _ in range(runs)]
+    report['warm_up_ms'] = {step: round(1000 * median([sample[step] for sample in warm_up]), 2)
+                            for step in warm_up[0]}
+    return report
+
+
+def print_startup(report):
+    for module in STARTUP_MODULES:
+        entry = report[module]
+        print(f"import {module:<20} {entry['total_ms']:>9.1f} ms  (own code {entry['self_ms']:.1f} ms)")
+        for name, cumulative_ms in entry['modules'].items():
+            print(f"    {name:<32} {cumulative_ms:>9.1f} ms")
+    print("warm_up")
+    for step, step_ms in report['warm_up_ms'].items():
+        print(f"    {step:<32} {step_ms:>9.1f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark EcoVision backend hot paths")
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=list(CASES),
+                        help="Cases to run (default: all)")
+    parser.add_argument("--images", default=DEFAULT_IMAGES,
+                        help="Glob for fixture images (default: src/images/*)")
+    parser.add_argument("--iterations", type=int, default=50, help="Operations per case")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent callers per case")
+    parser.add_argument("--warmup", type=int, default=5, help="Untimed operations before each case")
+    parser.add_argument("--stub-latency-ms", type=float, default=20.0,
+                        help="Latency added by the stub upstream to every response")
+    parser.add_argument("--stub-error-rate", type=float, default=0.0,
+                        help="Fraction of stub responses that fail with 503")
+    parser.add_argument("--seed", type=int, default=1234, help="Seed for stub error injection")
+    parser.add_argument("--verbose", action="store_true", help="Show trash_scanner's own output")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Baseline JSON from an earlier run to compare against")
+    parser.add_argument("--startup", action="store_true",
+                        help="Measure import and warm-up cost in fresh interpreters instead of running cases")
+    parser.add_argument("--startup-runs", type=int, default=5, help="Fresh interpreters per --startup measurement")
+    parser.add_argument("--startup-top", type=int, default=10, help="Direct imports listed per module with --startup")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        server = start_stub_server(args.stub_latency_ms, args.stub_error_rate, args.seed)
+        configure_environment(f'http://127.0.0.1:{server.server_address[1]}')
+        startup = profile_startup(max(1, args.startup_runs), args.startup_top)
+        server.shutdown()
+        print_startup(startup)
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump({'meta': {'commit': git_commit(), 'timestamp': datetime.now().isoformat(),
+                                    'python': platform.python_version(), 'args': vars(args)},
+                           'startup': startup}, output, indent=2)
+            print(f"Wrote {args.output}")
+        return 0
+
+    images = sorted(glob.glob(args.images))
+    if not images:
+        print(f"No fixture images match {args.images}", file=sys.stderr)
+        return 1
+
+    server = start_stub_server(args.stub_latency_ms, args.stub_error_rate, args.seed)
+    configure_environment(f'http://127.0.0.1:{server.server_address[1]}')
+
+    import logging
+    logging.disable(logging.INFO)
+    import app as app_module
+    import metrics
+    trash_scanner = app_module.trash_scanner
+    if trash_scanner is None:
+        print("trash_scanner could not be imported", file=sys.stderr)
+        return 1
+
+    cases = build_cases(app_module, trash_scanner, images)
+    results = []
+    for name in args.cases:
+        operation, inputs = cases[name]
+        # Cold cases must not be served from results cached by earlier cases
+        trash_scanner.classification_cache.clear()
+        trash_scanner.CACHE_ENABLED = name not in COLD_ROUTE_CASES
+        with open(os.devnull, 'w') as devnull:
+            # trash_scanner prints progress for every image
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+                result = run_case(name, operation, inputs, args.iterations, args.concurrency,
+                                  args.warmup, metrics)
+        results.append(result)
+        latency = result['latency_ms']
+        print(f"{name:<24} {result['throughput_per_s']:>9.1f} ops/s  p50 {latency['p50']:>8.2f} ms  "
+              f"p99 {latency['p99']:>8.2f} ms  errors {result['errors']:>3}  rss {result['peak_rss_mb']} MiB")
+    server.shutdown()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'images': [os.path.relpath(path, ROOT) for path in images],
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+        print(f"Wrote {args.output}")
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
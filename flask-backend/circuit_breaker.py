@@ -0,0 +1,355 @@
+"""Per-upstream circuit breakers with request hedging.
+
+Each upstream (Gemini classification, Gemini receipts) gets a breaker that
+tracks error rate and slow calls over a sliding time window:
+
+  * closed: calls go through and are recorded
+  * open: once enough calls in the window fail (errors, timeouts, 5xx/429)
+    or are slow, calls are rejected immediately so callers go straight to
+    their fallback instead of tying up a worker on a hung socket. Each
+    consecutive trip doubles the open period, up to a cap.
+  * half-open: after the open period a few probe calls are let through;
+    if they all succeed the breaker closes, otherwise it opens again.
+
+When the recent p95 latency spikes past a threshold, calls are hedged: if
+the first attempt has not answered within that p95, a second identical
+request is sent and whichever finishes first wins. The loser is not left
+holding resources: a losing thread attempt's response is closed when it
+arrives, and a losing coroutine is cancelled.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_BREAKER_ENABLED = os.environ.get('CIRCUIT_BREAKER', 'True').lower() == 'true'
+WINDOW_SECONDS = float(os.environ.get('CIRCUIT_WINDOW_SECONDS', 30))
+MIN_REQUESTS = int(os.environ.get('CIRCUIT_MIN_REQUESTS', 10))
+FAILURE_RATE = float(os.environ.get('CIRCUIT_FAILURE_RATE', 0.5))
+# Calls slower than this count as slow; a window of mostly slow calls also trips
+SLOW_CALL_SECONDS = float(os.environ.get('CIRCUIT_SLOW_CALL_SECONDS', 10))
+SLOW_CALL_RATE = float(os.environ.get('CIRCUIT_SLOW_CALL_RATE', 0.8))
+OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', 5))
+MAX_OPEN_SECONDS = float(os.environ.get('CIRCUIT_MAX_OPEN_SECONDS', 120))
+HALF_OPEN_PROBES = int(os.environ.get('CIRCUIT_HALF_OPEN_PROBES', 2))
+# Hedge once the recent p95 exceeds this many seconds (0 disables hedging)
+HEDGE_P95_SECONDS = float(os.environ.get('HEDGE_P95_SECONDS', 2.0))
+HEDGE_MAX_IN_FLIGHT = int(os.environ.get('HEDGE_MAX_IN_FLIGHT', 16))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+WINDOW_BUCKETS = 10
+LATENCY_SAMPLES = 200
+# Minimum successful samples before the p95 is trusted for hedging
+HEDGE_MIN_SAMPLES = 20
+
+# Threads for hedged calls: both attempts run here while the caller waits
+_hedge_pool = ThreadPoolExecutor(max_workers=2 * HEDGE_MAX_IN_FLIGHT, thread_name_prefix='hedge')
+_hedge_slots = threading.BoundedSemaphore(HEDGE_MAX_IN_FLIGHT)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open"""
+
+    def __init__(self, name):
+        super().__init__(f"Circuit for {name} is open")
+        self.name = name
+
+
+class CircuitBreaker:
+    """Sliding-window circuit breaker for one upstream"""
+
+    def __init__(self, name, window_seconds=WINDOW_SECONDS, min_requests=MIN_REQUESTS,
+                 failure_rate=FAILURE_RATE, slow_call_seconds=SLOW_CALL_SECONDS,
+                 slow_call_rate=SLOW_CALL_RATE, open_seconds=OPEN_SECONDS,
+                 max_open_seconds=MAX_OPEN_SECONDS, half_open_probes=HALF_OPEN_PROBES,
+                 hedge_p95_seconds=HEDGE_P95_SECONDS):
+        self.name = name
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.half_open_probes = half_open_probes
+        self.hedge_p95_seconds = hedge_p95_seconds
+
+        self._bucket_seconds = window_seconds / WINDOW_BUCKETS
+        # Ring of [bucket number, calls, failures, slow calls]
+        self._buckets = [[-1, 0, 0, 0] for _ in range(WINDOW_BUCKETS)]
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._p95 = None
+        self._p95_computed_at = 0.0
+
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._open_for = open_seconds
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+
+    # State transitions
+
+    def is_open(self):
+        """Whether calls are currently being rejected (no probe is due yet)"""
+        return self.state == OPEN and time.monotonic() - self._opened_at < self._open_for
+
+    def allow(self):
+        """Reserve a call; every True must be followed by exactly one record()"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self._open_for:
+                    metrics.count('circuit_breaker', self.name, 'rejected')
+                    return False
+                self._transition(HALF_OPEN)
+            if self._probes_in_flight >= self.half_open_probes:
+                metrics.count('circuit_breaker', self.name, 'rejected')
+                return False
+            self._probes_in_flight += 1
+            return True
+
+    def record(self, success, seconds):
+        """Report how a call reserved with allow() went"""
+        now = time.monotonic()
+        slow = seconds >= self.slow_call_seconds
+        with self._lock:
+            bucket = self._bucket(now)
+            bucket[1] += 1
+            if not success:
+                bucket[2] += 1
+            if slow:
+                bucket[3] += 1
+            if success:
+                self._latencies.append(seconds)
+
+            if self.state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if not success or slow:
+                    self._trip(now, backoff=True)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_probes:
+                        self._transition(CLOSED)
+                        self._open_for = self.open_seconds
+                        self._reset_window()
+            elif self.state == CLOSED and (not success or slow):
+                calls, failures, slow_calls = self._window_totals(now)
+                if calls >= self.min_requests and (
+                        failures / calls >= self.failure_rate or slow_calls / calls >= self.slow_call_rate):
+                    self._trip(now, backoff=False)
+
+    def _trip(self, now, backoff):
+        if backoff:
+            self._open_for = min(self._open_for * 2, self.max_open_seconds)
+        self._opened_at = now
+        self._transition(OPEN)
+        logger.warning(f"Circuit for {self.name} opened for {self._open_for:.1f}s")
+
+    def _transition(self, state):
+        self.state = state
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        metrics.count('circuit_breaker', self.name, state)
+
+    # Sliding window
+
+    def _bucket(self, now):
+        number = int(now / self._bucket_seconds)
+        bucket = self._buckets[number % WINDOW_BUCKETS]
+        if bucket[0] != number:
+            bucket[:] = [number, 0, 0, 0]
+        return bucket
+
+    def _window_totals(self, now):
+        oldest = int(now / self._bucket_seconds) - WINDOW_BUCKETS + 1
+        calls = failures = slow_calls = 0
+        for number, bucket_calls, bucket_failures, bucket_slow in self._buckets:
+            if number >= oldest:
+                calls += bucket_calls
+                failures += bucket_failures
+                slow_calls += bucket_slow
+        return calls, failures, slow_calls
+
+    def _reset_window(self):
+        for bucket in self._buckets:
+            bucket[:] = [-1, 0, 0, 0]
+
+    # Hedging
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging, or None when latency is normal"""
+        if not self.hedge_p95_seconds or len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        now = time.monotonic()
+        # Sorting a few hundred samples is cheap, but not worth doing on every call
+        if now - self._p95_computed_at > 1.0:
+            samples = sorted(self._latencies)
+            self._p95 = samples[int(0.95 * (len(samples) - 1))]
+            self._p95_computed_at = now
+        return self._p95 if self._p95 >= self.hedge_p95_seconds else None
+
+    # Calling through the breaker
+
+    def call(self, fn, is_failure=None):
+        """Run fn() through the breaker, hedging it when latency has spiked.
+
+        is_failure(result) marks results such as 5xx responses as failures.
+        Raises CircuitOpenError without calling fn when the circuit is open.
+        """
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+        delay = self.hedge_delay() if self.state == CLOSED else None
+        started = time.perf_counter()
+        try:
+            if delay is not None and _hedge_slots.acquire(blocking=False):
+                # _hedged() releases the slot once both attempts are done
+                result = self._hedged(fn, delay, is_failure)
+            else:
+                result = fn()
+        except Exception:
+            self.record(False, time.perf_counter() - started)
+            raise
+        self.record(not (is_failure and is_failure(result)), time.perf_counter() - started)
+        return result
+
+    def _hedged(self, fn, delay, is_failure):
+        attempts = []
+        winner = None
+        try:
+            # Attempts run on pool threads, so carry the caller's context along
+            attempts.append(_hedge_pool.submit(contextvars.copy_context().run, fn))
+            winner = attempts[0]
+            done, _ = wait(attempts, timeout=delay)
+            if done:
+                return winner.result()
+            metrics.count('circuit_breaker', self.name, 'hedged')
+            attempts.append(_hedge_pool.submit(contextvars.copy_context().run, fn))
+            pending = set(attempts)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None and not (is_failure and is_failure(future.result())):
+                        winner = future
+                        return winner.result()
+            # Both attempts failed; surface the primary's outcome
+            return winner.result()
+        finally:
+            _discard_losers(attempts, winner)
+
+    async def call_async(self, coroutine_fn, is_failure=None):
+        """Await coroutine_fn() through the breaker, like call()"""
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+        delay = self.hedge_delay() if self.state == CLOSED else None
+        started = time.perf_counter()
+        try:
+            if delay is None:
+                result = await coroutine_fn()
+            else:
+                result = await self._hedged_async(coroutine_fn, delay, is_failure)
+        except Exception:
+            self.record(False, time.perf_counter() - started)
+            raise
+        self.record(not (is_failure and is_failure(result)), time.perf_counter() - started)
+        return result
+
+    async def _hedged_async(self, coroutine_fn, delay, is_failure):
+        primary = asyncio.ensure_future(coroutine_fn())
+        attempts = [primary]
+        winner = primary
+        try:
+            done, _ = await asyncio.wait([primary], timeout=delay)
+            if done:
+                return primary.result()
+            metrics.count('circuit_breaker', self.name, 'hedged')
+            attempts.append(asyncio.ensure_future(coroutine_fn()))
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and not (is_failure and is_failure(task.result())):
+                        winner = task
+                        return task.result()
+            return primary.result()
+        finally:
+            # Unlike threads, the losing coroutine (or both, if we were
+            # cancelled ourselves) can be cancelled; one that already
+            # finished has its response, if it returned one, closed
+            for task in attempts:
+                if not task.done():
+                    task.cancel()
+                elif task is not winner and not task.cancelled() and task.exception() is None:
+                    close = getattr(task.result(), 'close', None)
+                    if close is not None:
+                        close()
+
+    def get_stats(self):
+        with self._lock:
+            calls, failures, slow_calls = self._window_totals(time.monotonic())
+            return {
+                'state': self.state,
+                'window_calls': calls,
+                'window_failures': failures,
+                'window_slow_calls': slow_calls,
+                'open_seconds': self._open_for,
+                'hedge_delay': self._p95 if self._p95 and self._p95 >= (self.hedge_p95_seconds or 0) else None
+            }
+
+
+def _discard_losers(attempts, winner):
+    """Close the responses of every attempt but winner as they finish, then free the hedge slot"""
+    remaining = [len(attempts)]
+    lock = threading.Lock()
+
+    def settle(future):
+        try:
+            if future is not winner and not future.cancelled() and future.exception() is None:
+                close = getattr(future.result(), 'close', None)
+                if close is not None:
+                    # Returns a stream=True response's connection to the pool
+                    close()
+        except Exception as e:
+            logger.debug(f"Could not close a losing hedged response: {str(e)}")
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                _hedge_slots.release()
+
+    if not attempts:
+        _hedge_slots.release()
+    for future in attempts:
+        future.add_done_callback(settle)
+
+
+def is_upstream_failure(status_code):
+    """Statuses that mean the upstream itself is struggling"""
+    return status_code >= 500 or status_code == 429
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """Return the shared breaker for an upstream, or None if breakers are disabled"""
+    if not CIRCUIT_BREAKER_ENABLED:
+        return None
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(name, CircuitBreaker(name))
+    return breaker
@@ -0,0 +1,30 @@
+"""Gunicorn configuration for the EcoVision backend.
+
+SERVER_MODE=sync (default) serves the Flask app with threaded workers.
+SERVER_MODE=async serves async_app on aiohttp workers, where each worker
+runs a single event loop for all upstream calls.
+"""
+import os
+import multiprocessing
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 4)))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+accesslog = '-'
+errorlog = '-'
+
+if os.environ.get('SERVER_MODE', 'sync').lower() == 'async':
+    wsgi_app = 'async_app:create_app'
+    worker_class = 'aiohttp.GunicornWebWorker'
+else:
+    wsgi_app = 'app:app'
+    worker_class = 'gthread'
+    threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+def post_worker_init(worker):
+    # Both server modes load app; warm it up without delaying the first accept
+    import app
+    app.start_warm_up()
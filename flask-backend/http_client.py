@@ -0,0 +1,101 @@
+"""Shared outbound HTTP client for calls to Supabase and Gemini.
+
+Every upstream host gets its own pooled, keep-alive ``requests.Session`` so
+the DNS + TCP + TLS handshake is paid once per connection instead of once
+per proxied request.
+"""
+import os
+import threading
+import logging
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Pool and timeout settings, overridable from the environment
+POOL_CONNECTIONS = int(os.environ.get('UPSTREAM_POOL_CONNECTIONS', 10))
+POOL_MAXSIZE = int(os.environ.get('UPSTREAM_POOL_MAXSIZE', 32))
+CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 15))
+MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', 2))
+BACKOFF_FACTOR = float(os.environ.get('UPSTREAM_BACKOFF_FACTOR', 0.2))
+BACKOFF_JITTER = float(os.environ.get('UPSTREAM_BACKOFF_JITTER', 0.2))
+
+# Only operations that are safe to repeat are retried
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+RETRY_STATUS_CODES = frozenset([429, 502, 503, 504])
+
+DEFAULT_TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class TimeoutSession(requests.Session):
+    """Session that applies the default connect/read timeout when none is given."""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def build_session(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                  max_retries=MAX_RETRIES, timeout=DEFAULT_TIMEOUT):
+    """Create a pooled keep-alive session with retries for idempotent requests"""
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        status=max_retries,
+        allowed_methods=IDEMPOTENT_METHODS,
+        status_forcelist=RETRY_STATUS_CODES,
+        backoff_factor=BACKOFF_FACTOR,
+        backoff_jitter=BACKOFF_JITTER,
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=retry,
+        pool_block=False
+    )
+    session = TimeoutSession(timeout=timeout)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(url):
+    """Return the shared session for the host that ``url`` points at"""
+    parts = urlsplit(url)
+    host = f"{parts.scheme}://{parts.netloc}"
+    session = _sessions.get(host)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(host)
+            if session is None:
+                logger.info(f"Creating connection pool for {host} (maxsize={POOL_MAXSIZE})")
+                session = build_session()
+                _sessions[host] = session
+    return session
+
+
+def request(method, url, **kwargs):
+    """Send a request through the pooled session for the URL's host"""
+    return get_session(url).request(method, url, **kwargs)
+
+
+def close_sessions():
+    """Close every pooled session, e.g. on worker shutdown"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
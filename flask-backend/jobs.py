@@ -0,0 +1,314 @@
+"""Persistent background jobs for slow receipt and scan processing.
+
+Instead of holding a connection open for the whole Gemini round trip, a
+client can submit work as a job: the request returns a job id at once and
+the work runs on a bounded pool of worker threads. Clients then poll
+``/api/jobs/<id>`` or subscribe to ``/api/jobs/<id>/events`` (Server-Sent
+Events) for the result.
+
+Jobs live in a SQLite file so they survive a worker restart and are
+shared by every gunicorn worker on the host: any worker can answer a poll,
+and workers claim queued jobs with a write transaction so each runs once.
+A job whose worker died is picked up again once its lease runs out.
+CPU-heavy image work inside a job is handed to a process pool so it does
+not hold the GIL away from the I/O threads.
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+JOBS_ENABLED = os.environ.get('JOB_QUEUE', 'True').lower() == 'true'
+JOB_DB_PATH = os.environ.get('JOB_QUEUE_DB', os.path.join(tempfile.gettempdir(), 'ecovision_jobs.sqlite3'))
+# Worker threads per server process; most of a job is waiting on Gemini
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_PROCESS_WORKERS = int(os.environ.get('JOB_PROCESS_WORKERS', os.cpu_count() or 1))
+# Queued jobs accepted before submissions are turned away with a 503
+JOB_QUEUE_MAX = int(os.environ.get('JOB_QUEUE_MAX', 1000))
+# A running job not finished within its lease is assumed lost and retried
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', 300))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 2))
+# Finished jobs (and their results) are kept this long for clients to collect
+JOB_RESULT_TTL = float(os.environ.get('JOB_RESULT_TTL', 3600))
+# How often idle workers and event streams check for changes made by other processes
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', 0.5))
+JOB_HEARTBEAT_SECONDS = 15
+JOB_EVENTS_TIMEOUT = float(os.environ.get('JOB_EVENTS_TIMEOUT', 300))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+FINISHED = (SUCCEEDED, FAILED)
+
+PURGE_INTERVAL = 60
+
+
+class QueueFull(Exception):
+    """Raised when too many jobs are already waiting"""
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def run_in_process(fn, *args):
+    """Run a picklable CPU-bound function in the shared job process pool"""
+    global _process_pool
+    if _process_pool is None:
+        with _process_pool_lock:
+            if _process_pool is None:
+                # spawn, because the server process is multi-threaded
+                _process_pool = ProcessPoolExecutor(
+                    max_workers=JOB_PROCESS_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+    return _process_pool.submit(fn, *args).result()
+
+
+def format_event(event, data):
+    """Encode one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class JobQueue:
+    """SQLite-backed job queue with a pool of worker threads.
+
+    handlers maps a job kind to a function that takes the job's payload
+    bytes and returns a JSON-serializable result; an exception fails the
+    job with its message. If run_as is given, handlers run inside
+    run_as(owner), the context manager for whoever submitted the job.
+    """
+
+    def __init__(self, db_path, handlers, workers=JOB_WORKERS, max_queued=JOB_QUEUE_MAX,
+                 lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS,
+                 result_ttl=JOB_RESULT_TTL, run_as=None):
+        self.db_path = db_path
+        self.handlers = dict(handlers)
+        self.run_as = run_as
+        self.workers = workers
+        self.max_queued = max_queued
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(threading.Lock())
+        self._listeners = []
+        self._threads = []
+        self._purged_at = 0.0
+        self._db = self._open_db()
+
+    def _open_db(self):
+        # Autocommit, with explicit transactions where a read and a write must be atomic
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                payload BLOB,
+                owner TEXT,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                lease_expires_at REAL
+            )
+        """)
+        if 'owner' not in {row[1] for row in db.execute("PRAGMA table_info(jobs)")}:
+            # Queue files created before jobs recorded who submitted them
+            db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+        return db
+
+    def start(self):
+        """Start the worker threads (safe to call more than once)"""
+        with self._lock:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'job-worker-{number}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    # Submitting and reading jobs
+
+    def submit(self, kind, payload, owner=None):
+        """Queue a job and return its id; raises QueueFull when the queue is full"""
+        if kind not in self.handlers:
+            raise ValueError(f'Unknown job kind: {kind}')
+        self.start()
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            (queued,) = self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()
+            if queued >= self.max_queued:
+                metrics.count('jobs', kind, 'rejected')
+                raise QueueFull(f'{queued} jobs are already queued')
+            self._db.execute(
+                "INSERT INTO jobs (id, kind, status, payload, owner, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, QUEUED, sqlite3.Binary(payload), owner, time.time()))
+        metrics.count('jobs', kind, 'submitted')
+        self._notify(job_id)
+        return job_id
+
+    def get(self, job_id):
+        """Return a job's public state, or None if it does not exist"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, kind, status, result, error, created_at, started_at, finished_at"
+                " FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = {
+            'id': row[0],
+            'kind': row[1],
+            'status': row[2],
+            'created_at': row[5],
+            'started_at': row[6],
+            'finished_at': row[7]
+        }
+        if row[2] == SUCCEEDED:
+            job['result'] = json.loads(row[3])
+        elif row[2] == FAILED:
+            job['error'] = row[4]
+        return job
+
+    def wait(self, job_id, status, timeout):
+        """Block until a job's status differs from status, or timeout passes.
+
+        Returns the job's current state (None if it does not exist).
+        Changes made in this process wake the caller at once; changes made
+        by other processes are noticed within JOB_POLL_SECONDS.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job['status'] != status or remaining <= 0:
+                return job
+            with self._changed:
+                self._changed.wait(min(remaining, JOB_POLL_SECONDS))
+
+    def add_listener(self, listener):
+        """Call listener(job_id) from a worker thread whenever a job changes"""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def _notify(self, job_id):
+        with self._changed:
+            self._changed.notify_all()
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(job_id)
+
+    # Running jobs
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                logger.error(f"Could not claim a job: {str(e)}")
+                job = None
+            if job is None:
+                with self._changed:
+                    self._changed.wait(JOB_POLL_SECONDS)
+                continue
+            self._run(*job)
+
+    def _claim(self):
+        """Atomically take the oldest queued job, recovering lost ones first"""
+        with self._lock:
+            now = time.time()
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # Jobs whose worker died get another attempt, up to max_attempts
+                self._db.execute(
+                    "UPDATE jobs SET status = ?, error = 'Job was interrupted', finished_at = ?, payload = NULL"
+                    " WHERE status = ? AND lease_expires_at < ? AND attempts >= ?",
+                    (FAILED, now, RUNNING, now, self.max_attempts))
+                self._db.execute(
+                    "UPDATE jobs SET status = ? WHERE status = ? AND lease_expires_at < ?",
+                    (QUEUED, RUNNING, now))
+                row = self._db.execute(
+                    "SELECT id, kind, payload, owner, created_at, attempts FROM jobs WHERE status = ?"
+                    " ORDER BY created_at LIMIT 1", (QUEUED,)).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE jobs SET status = ?, attempts = attempts + 1, started_at = ?,"
+                        " lease_expires_at = ? WHERE id = ?",
+                        (RUNNING, now, now + self.lease_seconds, row[0]))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        if now - self._purged_at > PURGE_INTERVAL:
+            self._purge(now)
+        if row is None:
+            return None
+        metrics.observe_stage('job_queue_wait', max(0.0, now - row[4]))
+        self._notify(row[0])
+        # The attempt number identifies this claim when the result is stored
+        return row[0], row[1], bytes(row[2]), row[3], row[5] + 1
+
+    def _run(self, job_id, kind, payload, owner, attempt):
+        started = time.perf_counter()
+        try:
+            if self.run_as is None:
+                result = self.handlers[kind](payload)
+            else:
+                with self.run_as(owner):
+                    result = self.handlers[kind](payload)
+            values = (SUCCEEDED, json.dumps(result), None)
+        except Exception as e:
+            logger.error(f"Job {job_id} ({kind}) failed: {str(e)}")
+            values = (FAILED, None, str(e))
+        metrics.observe_stage(f'job_{kind}', time.perf_counter() - started)
+        metrics.count('jobs', kind, values[0])
+        try:
+            with self._lock:
+                # Only store the result while this attempt still holds the lease
+                stored = self._db.execute(
+                    "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, payload = NULL"
+                    " WHERE id = ? AND status = ? AND attempts = ?",
+                    (*values, time.time(), job_id, RUNNING, attempt)).rowcount
+        except sqlite3.Error as e:
+            # The lease will run out and the job will be retried
+            logger.error(f"Could not store the result of job {job_id}: {str(e)}")
+            return
+        if not stored:
+            logger.warning(f"Dropped the result of job {job_id} attempt {attempt}: its lease was lost")
+            return
+        self._notify(job_id)
+
+    def _purge(self, now):
+        self._purged_at = now
+        try:
+            with self._lock:
+                self._db.execute("DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                                 (*FINISHED, now - self.result_ttl))
+        except sqlite3.Error as e:
+            logger.error(f"Could not purge finished jobs: {str(e)}")
+
+    def get_stats(self):
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
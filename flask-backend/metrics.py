@@ -0,0 +1,243 @@
+"""Per-stage latency histograms and event counters for the backend.
+
+Each thread records into its own shard, so the hot path takes no locks:
+an observation is a bisect into the bucket bounds and two list updates on
+data only that thread writes. A scrape of ``/metrics`` sums the shards and
+renders them in the Prometheus text format, with p50/p95/p99 estimated from
+the histogram buckets. When a thread exits its shard is folded into a
+shared base shard, so a server that churns through threads keeps one shard
+per live thread rather than one per thread it ever ran.
+"""
+import itertools
+import os
+import time
+import threading
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'True').lower() == 'true'
+
+PREFIX = 'ecovision_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram bucket upper bounds in seconds (an implicit +Inf bucket follows)
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Counter name -> (label names, help text)
+COUNTERS = {
+    'cache_lookups': (('result',), 'Classification cache lookups by result'),
+    'supabase_cache': (('result',), 'Supabase select cache lookups by result'),
+    'supabase_passthrough': (('encoding',), 'Supabase selects streamed to the client unparsed, by content coding'),
+    'fallbacks': (('path',), 'Requests served by a fallback instead of the upstream model'),
+    'upstream_responses': (('upstream', 'status'), 'Upstream responses by status code'),
+    'micro_batches': (('size',), 'Multi-image Gemini classification calls by number of images'),
+    'micro_batch_items': (('result',), 'Images sent in multi-image calls, by whether the reply classified them'),
+    'gemini_tokens': (('kind',), 'Gemini classification tokens billed, prompt or output'),
+    'gemini_replies': (('result',), 'Gemini classification replies by whether they parsed and validated'),
+    'ladder_rungs': (('rung', 'outcome'), 'Scan uploads by ladder rung, and whether low confidence sent them up to the top rung'),
+    'image_upload_bytes': (('rung',), 'Base64 image bytes uploaded to Gemini, by ladder rung'),
+    'circuit_breaker': (('upstream', 'event'), 'Circuit breaker state changes, rejections and hedged calls'),
+    'jobs': (('kind', 'event'), 'Background jobs submitted, rejected, succeeded and failed'),
+    'rate_limited': (('route',), 'Requests turned away with a 429 by the rate limiter'),
+    'upstream_slots': (('event',), 'Upstream calls that gave up waiting for a fair-share slot'),
+    'event_streams': (('event',), 'Server-Sent Event streams turned away at SSE_MAX_STREAMS'),
+}
+
+
+class _ShardOwner:
+    """Per-thread handle whose collection, when its thread exits, retires the thread's shard"""
+    __slots__ = ('shard', '__weakref__')
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+class Registry:
+    """Thread-sharded registry of stage latency histograms and counters"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS, enabled=True):
+        self.buckets = tuple(buckets)
+        self.enabled = enabled
+        self._local = threading.local()
+        # Live shards by id, and the totals of the threads that have exited
+        self._shards = {}
+        self._shard_ids = itertools.count()
+        self._base = ({}, {})
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.owner.shard
+        except AttributeError:
+            # (histograms, counters); only the owning thread ever writes to it
+            shard = ({}, {})
+            shard_id = next(self._shard_ids)
+            with self._shards_lock:
+                self._shards[shard_id] = shard
+            owner = self._local.owner = _ShardOwner(shard)
+            # The thread-local drops the owner when its thread exits
+            weakref.finalize(owner, self._retire, shard_id)
+            return shard
+
+    def _retire(self, shard_id):
+        with self._shards_lock:
+            shard = self._shards.pop(shard_id, None)
+            if shard is not None:
+                _add_shard(self._base, shard)
+
+    def observe_stage(self, stage, seconds):
+        """Record how long one pass through a stage took"""
+        if not self.enabled:
+            return
+        histograms = self._shard()[0]
+        histogram = histograms.get(stage)
+        if histogram is None:
+            # One count per bucket, the +Inf bucket, then the running sum
+            histogram = histograms[stage] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def count(self, name, *labels, amount=1):
+        """Increment a counter declared in COUNTERS, by one unless amount says otherwise"""
+        if not self.enabled:
+            return
+        counters = self._shard()[1]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    @contextmanager
+    def span(self, stage):
+        """Time the body of a with-block as one pass through stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - started)
+
+    def _merged(self):
+        merged = ({}, {})
+        with self._shards_lock:
+            # The base only changes under the lock, so copy it here
+            _add_shard(merged, self._base)
+            shards = list(self._shards.values())
+        for shard in shards:
+            _add_shard(merged, shard)
+        return merged
+
+    def _quantile(self, histogram, q):
+        """Estimate a quantile by interpolating inside its bucket, like histogram_quantile()"""
+        total = sum(histogram[:-1])
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for index, bucket_count in enumerate(histogram[:-1]):
+            if seen + bucket_count >= rank and bucket_count:
+                if index == len(self.buckets):
+                    # Past the last finite bound there is nothing to interpolate against
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def snapshot(self):
+        """Current counts, sums and estimated quantiles as plain data"""
+        histograms, counters = self._merged()
+        stages = {}
+        for stage, histogram in sorted(histograms.items()):
+            stats = {'count': sum(histogram[:-1]), 'sum': histogram[-1]}
+            for q in QUANTILES:
+                stats[f'p{int(q * 100)}'] = self._quantile(histogram, q)
+            stages[stage] = stats
+        return {
+            'stages': stages,
+            'counters': {
+                f"{name}{{{','.join(labels)}}}": value
+                for (name, labels), value in sorted(counters.items())
+            }
+        }
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        histograms, counters = self._merged()
+        bounds = [_format_float(bound) for bound in self.buckets] + ['+Inf']
+        duration = f'{PREFIX}stage_duration_seconds'
+        quantile = f'{PREFIX}stage_duration_quantile_seconds'
+        lines = [
+            f'# HELP {duration} Time spent in each request handling stage',
+            f'# TYPE {duration} histogram',
+        ]
+        for stage, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, histogram):
+                cumulative += bucket_count
+                lines.append(f'{duration}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{duration}_sum{{stage="{stage}"}} {_format_float(histogram[-1])}')
+            lines.append(f'{duration}_count{{stage="{stage}"}} {cumulative}')
+
+        lines.append(f'# HELP {quantile} Stage latency quantiles estimated from the histogram buckets')
+        lines.append(f'# TYPE {quantile} gauge')
+        for stage, histogram in sorted(histograms.items()):
+            for q in QUANTILES:
+                value = _format_float(self._quantile(histogram, q))
+                lines.append(f'{quantile}{{stage="{stage}",quantile="{q}"}} {value}')
+
+        for name, (label_names, help_text) in COUNTERS.items():
+            metric = f'{PREFIX}{name}_total'
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} counter')
+            for (counter, labels), value in sorted(counters.items()):
+                if counter != name:
+                    continue
+                label_text = ','.join(
+                    f'{label}="{_escape(label_value)}"' for label, label_value in zip(label_names, labels))
+                lines.append(f'{metric}{{{label_text}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Drop every recorded observation (mainly for benchmarks)"""
+        with self._shards_lock:
+            for histograms, counters in [self._base, *self._shards.values()]:
+                histograms.clear()
+                counters.clear()
+
+
+def _add_shard(into, shard):
+    """Add the histograms and counters of shard into the shard into"""
+    histograms, counters = into
+    shard_histograms, shard_counters = shard
+    # dict() and list() copies are atomic under the GIL, so the owning
+    # thread can keep writing while we read
+    for stage, histogram in dict(shard_histograms).items():
+        merged = histograms.get(stage)
+        if merged is None:
+            histograms[stage] = list(histogram)
+        else:
+            for index, value in enumerate(list(histogram)):
+                merged[index] += value
+    for key, value in dict(shard_counters).items():
+        counters[key] = counters.get(key, 0) + value
+
+
+def _format_float(value):
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Process-wide registry used by the Flask and aiohttp apps and by trash_scanner
+REGISTRY = Registry(enabled=METRICS_ENABLED)
+
+observe_stage = REGISTRY.observe_stage
+count = REGISTRY.count
+span = REGISTRY.span
+render = REGISTRY.render
+snapshot = REGISTRY.snapshot
@@ -0,0 +1,411 @@
+"""Rate limiting and fair scheduling for calls that reach Gemini.
+
+Two layers keep one client from exhausting the upstream quota:
+
+  * Token buckets at the edge: every client (signed-in user, else IP) has
+    its own bucket and all clients share a global one. A request that
+    would overdraw either gets a 429 with Retry-After; nothing is queued.
+  * A weighted fair-queue scheduler for upstream slots: only
+    UPSTREAM_SLOTS Gemini calls are in flight per process. When they are
+    all busy, waiting calls are granted slots in weighted-fair order across
+    clients (start-time fair queueing) rather than first come, first
+    served, so one client's batch cannot push everyone else's scans to the
+    back of the line.
+
+Buckets live in memory by default. Set RATE_LIMIT_BACKEND=sqlite to share
+them between the gunicorn workers on a host through a SQLite file; any
+object with the same take() method can stand in for either backend.
+"""
+import os
+import hmac
+import json
+import math
+import time
+import base64
+import heapq
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager, asynccontextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT', 'True').lower() == 'true'
+# Per-client bucket: sustained calls per second and burst size
+CLIENT_RATE = float(os.environ.get('RATE_LIMIT_CLIENT_RATE', 0.5))
+CLIENT_BURST = float(os.environ.get('RATE_LIMIT_CLIENT_BURST', 10))
+# Bucket shared by every client, sized to the Gemini quota
+GLOBAL_RATE = float(os.environ.get('RATE_LIMIT_GLOBAL_RATE', 10))
+GLOBAL_BURST = float(os.environ.get('RATE_LIMIT_GLOBAL_BURST', 40))
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory').lower()
+RATE_LIMIT_DB_PATH = os.environ.get('RATE_LIMIT_DB', os.path.join(tempfile.gettempdir(), 'ecovision_rate_limit.sqlite3'))
+# X-Forwarded-For entries appended by our own proxies. 0 trusts only the
+# socket address; behind Railway's router, which adds one, set it to 1
+PROXY_HOPS = int(os.environ.get('RATE_LIMIT_PROXY_HOPS', 0))
+# Secret the Supabase JWTs (Clerk's "supabase" template) are signed with. Only
+# tokens verified against it get a bucket of their own; without it every
+# caller is keyed by IP
+SUPABASE_JWT_SECRET = os.environ.get('SUPABASE_JWT_SECRET')
+# Clock skew tolerated when checking a token's exp and nbf
+JWT_LEEWAY_SECONDS = 30
+
+# Concurrent upstream calls per process, and how long a call waits for a slot
+UPSTREAM_SLOTS = int(os.environ.get('UPSTREAM_SLOTS', 16))
+SLOT_WAIT_SECONDS = float(os.environ.get('UPSTREAM_SLOT_WAIT_SECONDS', 30))
+
+MEMORY_MAX_BUCKETS = 100000
+ANONYMOUS = 'anonymous'
+
+
+def parse_weights(value):
+    """Parse "user=2,ip=1" scheduler weights by client kind"""
+    weights = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        try:
+            kind, weight = item.split('=', 1)
+            weights[kind.strip()] = float(weight)
+        except ValueError:
+            logger.error(f"Ignoring invalid UPSTREAM_WEIGHTS entry: {item}")
+    return weights
+
+
+# Share of upstream slots each kind of client gets under contention
+DEFAULT_WEIGHTS = {'user': 1.0, 'ip': 1.0}
+WEIGHTS = dict(DEFAULT_WEIGHTS, **parse_weights(os.environ.get('UPSTREAM_WEIGHTS')))
+
+# The client on whose behalf the current request (or job) calls upstream
+current_client = contextvars.ContextVar('rate_limit_client', default=ANONYMOUS)
+
+
+def _b64url_decode(segment):
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def verified_subject(token, secret=None, now=None):
+    """The sub claim of an HS256 JWT signed with secret, or None if it does not verify.
+
+    The signature, exp and nbf are checked; anything malformed, expired or
+    signed with another key or algorithm is rejected.
+    """
+    secret = secret if secret is not None else SUPABASE_JWT_SECRET
+    if not secret or not token:
+        return None
+    try:
+        header, payload, signature = token.split('.')
+        if json.loads(_b64url_decode(header)).get('alg') != 'HS256':
+            return None
+        expected = hmac.new(secret.encode('utf-8'), f'{header}.{payload}'.encode('ascii'), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64url_decode(signature)):
+            return None
+        claims = json.loads(_b64url_decode(payload))
+    except (ValueError, TypeError, UnicodeError):
+        return None
+    if not isinstance(claims, dict):
+        return None
+    now = time.time() if now is None else now
+    try:
+        if 'exp' in claims and now > float(claims['exp']) + JWT_LEEWAY_SECONDS:
+            return None
+        if 'nbf' in claims and now < float(claims['nbf']) - JWT_LEEWAY_SECONDS:
+            return None
+    except (TypeError, ValueError):
+        return None
+    subject = claims.get('sub')
+    return subject if isinstance(subject, str) and subject else None
+
+
+def client_key(authorization, remote_addr, forwarded_for=None):
+    """Identify the caller: the verified user of their bearer token, else their IP.
+
+    Unverified tokens are ignored, so inventing a new token per request
+    cannot mint a fresh bucket.
+    """
+    if authorization and authorization.startswith('Bearer '):
+        subject = verified_subject(authorization[7:].strip())
+        if subject is not None:
+            return 'user:' + hashlib.sha256(subject.encode('utf-8')).hexdigest()[:32]
+    if forwarded_for and PROXY_HOPS > 0:
+        # Entries left of the ones our proxies appended are client-controlled
+        hops = [hop.strip() for hop in forwarded_for.split(',')]
+        if len(hops) >= PROXY_HOPS:
+            return 'ip:' + hops[-PROXY_HOPS]
+    return 'ip:' + (remote_addr or 'unknown')
+
+
+@contextmanager
+def client_scope(client):
+    """Attribute upstream calls made inside the block to client"""
+    token = current_client.set(client or ANONYMOUS)
+    try:
+        yield
+    finally:
+        current_client.reset(token)
+
+
+# Token buckets
+
+def _refill(tokens, updated_at, rate, burst, now):
+    if tokens is None:
+        return burst
+    return min(burst, tokens + (now - updated_at) * rate)
+
+
+def _retry_after(tokens, cost, rate):
+    return (cost - tokens) / rate if rate > 0 else math.inf
+
+
+class MemoryBackend:
+    """Token buckets in a dict, local to this process"""
+
+    def __init__(self, max_buckets=MEMORY_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, buckets, cost, now):
+        """Take cost tokens from every (key, rate, burst) bucket, or from none.
+
+        Returns 0 if the tokens were taken, else the seconds until they
+        would all be available.
+        """
+        with self._lock:
+            levels = []
+            wait = 0.0
+            for key, rate, burst in buckets:
+                tokens, updated_at = self._buckets.get(key, (None, now))
+                tokens = _refill(tokens, updated_at, rate, burst, now)
+                levels.append(tokens)
+                if tokens < cost:
+                    wait = max(wait, _retry_after(tokens, cost, rate))
+            if wait:
+                return wait
+            for (key, rate, burst), tokens in zip(buckets, levels):
+                self._buckets[key] = (tokens - cost, now)
+            if len(self._buckets) > self.max_buckets:
+                self._prune(now)
+            return 0.0
+
+    def _prune(self, now):
+        # A bucket idle long enough to have refilled is the same as a missing one
+        idle = CLIENT_BURST / CLIENT_RATE if CLIENT_RATE > 0 else 3600
+        for key in [key for key, (_, updated_at) in self._buckets.items() if now - updated_at > idle]:
+            del self._buckets[key]
+
+
+class SQLiteBackend:
+    """Token buckets in a SQLite file shared by every worker process on the host"""
+
+    def __init__(self, db_path):
+        self._db = sqlite3.connect(db_path, timeout=1, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+        self._lock = threading.Lock()
+
+    def take(self, buckets, cost, now):
+        """Same contract as MemoryBackend.take(), atomic across processes"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                levels = []
+                wait = 0.0
+                for key, rate, burst in buckets:
+                    row = self._db.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+                    tokens = _refill(row[0] if row else None, row[1] if row else now, rate, burst, now)
+                    levels.append(tokens)
+                    if tokens < cost:
+                        wait = max(wait, _retry_after(tokens, cost, rate))
+                if not wait:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                        [(key, tokens - cost, now) for (key, _, _), tokens in zip(buckets, levels)])
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            return wait
+
+
+class RateLimiter:
+    """Per-client and global token buckets in front of the upstream"""
+
+    def __init__(self, backend, client_rate=CLIENT_RATE, client_burst=CLIENT_BURST,
+                 global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST):
+        self.backend = backend
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+
+    def check(self, client, cost=1):
+        """Spend cost tokens for client; returns 0, or seconds to wait before retrying.
+
+        A cost larger than a bucket's burst drains the whole bucket instead
+        of being refused forever.
+        """
+        buckets = [('client:' + client, self.client_rate, self.client_burst),
+                   ('global', self.global_rate, self.global_burst)]
+        cost = min(cost, self.client_burst, self.global_burst)
+        try:
+            return self.backend.take(buckets, cost, time.time())
+        except sqlite3.Error as e:
+            # Failing open beats turning every request away over a busy file
+            logger.error(f"Rate limit backend unavailable, allowing request: {str(e)}")
+            return 0.0
+
+
+def retry_after_header(seconds):
+    """Retry-After value: whole seconds, rounded up"""
+    return str(max(1, math.ceil(seconds)))
+
+
+# Weighted fair scheduling of upstream slots
+
+class SlotTimeout(Exception):
+    """Raised when no upstream slot frees up within the wait limit"""
+
+
+class _Waiter:
+    __slots__ = ('notify', 'granted', 'cancelled')
+
+    def __init__(self, notify):
+        self.notify = notify
+        self.granted = False
+        self.cancelled = False
+
+
+class FairScheduler:
+    """Hands out a fixed number of upstream slots in weighted-fair order.
+
+    Each waiting call gets a virtual finish tag of
+    max(virtual time, the client's previous tag) + cost / weight, and freed
+    slots go to the smallest tag. A client with many queued calls therefore
+    only gets its weighted share while others are waiting too, and can use
+    every slot when nobody else is.
+    """
+
+    def __init__(self, slots=UPSTREAM_SLOTS, weights=None, max_wait=SLOT_WAIT_SECONDS):
+        self.slots = slots
+        self.weights = dict(weights or WEIGHTS)
+        self.max_wait = max_wait
+        self.in_use = 0
+        self._lock = threading.Lock()
+        self._heap = []
+        self._sequence = 0
+        self._virtual_time = 0.0
+        self._last_finish = {}
+
+    def weight(self, client):
+        return self.weights.get(client.split(':', 1)[0], 1.0)
+
+    def _enqueue(self, client, cost, notify):
+        """Take a free slot (returns None) or queue a waiter for one"""
+        with self._lock:
+            if self.in_use < self.slots and not self._heap:
+                self.in_use += 1
+                return None
+            start = max(self._virtual_time, self._last_finish.get(client, 0.0))
+            finish = start + cost / self.weight(client)
+            self._last_finish[client] = finish
+            waiter = _Waiter(notify)
+            self._sequence += 1
+            heapq.heappush(self._heap, (finish, self._sequence, start, waiter))
+            return waiter
+
+    def _cancel(self, waiter):
+        """Give up waiting; returns True if the slot was granted meanwhile"""
+        with self._lock:
+            if waiter.granted:
+                return True
+            waiter.cancelled = True
+            return False
+
+    def release(self):
+        """Free a slot, handing it straight to the next waiter in fair order"""
+        with self._lock:
+            while self._heap:
+                _, _, start, waiter = heapq.heappop(self._heap)
+                if waiter.cancelled:
+                    continue
+                self._virtual_time = start
+                waiter.granted = True
+                waiter.notify()
+                return
+            self.in_use -= 1
+            if not self.in_use:
+                # Idle: forget history so tags do not grow without bound
+                self._virtual_time = 0.0
+                self._last_finish.clear()
+
+    @contextmanager
+    def slot(self, cost=1):
+        """Hold an upstream slot for the current client around a call"""
+        event = threading.Event()
+        started = time.perf_counter()
+        waiter = self._enqueue(current_client.get(), cost, event.set)
+        if waiter is not None and not event.wait(self.max_wait) and not self._cancel(waiter):
+            metrics.count('upstream_slots', 'timeout')
+            raise SlotTimeout(f'No upstream slot within {self.max_wait}s')
+        metrics.observe_stage('upstream_slot_wait', time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def slot_async(self, cost=1):
+        """slot() for coroutines: waits on the event loop instead of blocking"""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+
+        started = time.perf_counter()
+        waiter = self._enqueue(current_client.get(), cost, notify)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(granted), self.max_wait)
+            except asyncio.TimeoutError:
+                if not self._cancel(waiter):
+                    metrics.count('upstream_slots', 'timeout')
+                    raise SlotTimeout(f'No upstream slot within {self.max_wait}s')
+            except asyncio.CancelledError:
+                if self._cancel(waiter):
+                    self.release()
+                raise
+        metrics.observe_stage('upstream_slot_wait', time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'slots': self.slots,
+                'in_use': self.in_use,
+                'waiting': sum(1 for _, _, _, waiter in self._heap if not waiter.cancelled)
+            }
+
+
+def _make_backend():
+    if RATE_LIMIT_BACKEND == 'sqlite':
+        try:
+            return SQLiteBackend(RATE_LIMIT_DB_PATH)
+        except sqlite3.Error as e:
+            logger.error(f"Falling back to in-memory rate limits: {str(e)}")
+    return MemoryBackend()
+
+
+# Shared by the Flask and aiohttp apps and, through a hook, trash_scanner
+limiter = RateLimiter(_make_backend()) if RATE_LIMIT_ENABLED else None
+scheduler = FairScheduler() if UPSTREAM_SLOTS > 0 else None
@@ -0,0 +1,316 @@
+"""Server-side receipt parsing.
+
+Turns the text Gemini extracts from a receipt into structured items with
+eco-friendliness and an estimated carbon footprint. Everything expensive
+(the token patterns, the lexicon automaton and the carbon table) is built
+once at import so parsing can run inline on every upload and in bulk
+backfills.
+"""
+import re
+from functools import lru_cache
+
+# Words that mark a line as a total or payment detail rather than an item
+SKIP_WORDS = frozenset((
+    'total', 'subtotal', 'tax', 'change', 'cash', 'visa', 'mastercard', 'amex',
+    'discover', 'debit', 'credit', 'balance', 'tend', 'tender', 'tendered',
+    'payment', 'saved', 'sold', 'auth', 'approval',
+))
+
+# Receipt lines are tokenized on whitespace and read from both ends:
+#   "[1.] [2 x] NAME [2 @ 1.99] [012345678] [$]3.98 [F]"
+_PRICE = re.compile(r'-?\$?(\d{1,5}[.,]\d{2})')
+_UNIT_PRICE = re.compile(r'(\d{1,3})@\$?\d{1,5}[.,]\d{2}')
+_QUANTITY_SEPARATORS = frozenset(('x', 'X', '*'))
+
+_WORD = re.compile(r"[a-z0-9]+(?:['-][a-z0-9]+)*")
+
+# Words that mark an item as eco-friendly
+ECO_TERMS = (
+    'organic', 'local', 'locally grown', 'reusable', 'recycled', 'compostable',
+    'biodegradable', 'bamboo', 'fair trade', 'bulk', 'refill', 'plant based',
+    'plant-based', 'vegan', 'eco', 'glass jar', 'beeswax', 'led',
+)
+
+# Words that mark an item as not eco-friendly (these win over ECO_TERMS)
+NON_ECO_TERMS = (
+    'plastic', 'styrofoam', 'disposable', 'single use', 'single-use', 'bottled water',
+    'water bottles', 'plastic bags', 'straws', 'k-cups',
+)
+
+# Product categories: term -> (category, typical kg CO2e per unit sold)
+CATEGORY_TERMS = {
+    'beef': ('Meat', 6.0),
+    'steak': ('Meat', 6.0),
+    'ground beef': ('Meat', 6.0),
+    'lamb': ('Meat', 5.0),
+    'pork': ('Meat', 1.8),
+    'bacon': ('Meat', 1.8),
+    'ham': ('Meat', 1.8),
+    'chicken': ('Meat', 1.5),
+    'turkey': ('Meat', 1.5),
+    'fish': ('Seafood', 1.3),
+    'salmon': ('Seafood', 1.3),
+    'shrimp': ('Seafood', 2.0),
+    'cheese': ('Dairy', 2.1),
+    'butter': ('Dairy', 2.4),
+    'milk': ('Dairy', 1.0),
+    'yogurt': ('Dairy', 0.6),
+    'eggs': ('Dairy', 0.6),
+    'coffee': ('Beverages', 0.8),
+    'soda': ('Beverages', 0.4),
+    'juice': ('Beverages', 0.5),
+    'water': ('Beverages', 0.2),
+    'beer': ('Beverages', 0.6),
+    'wine': ('Beverages', 1.2),
+    'rice': ('Grains', 0.8),
+    'pasta': ('Grains', 0.4),
+    'bread': ('Grains', 0.4),
+    'cereal': ('Grains', 0.4),
+    'flour': ('Grains', 0.3),
+    'tofu': ('Protein', 0.3),
+    'beans': ('Protein', 0.2),
+    'lentils': ('Protein', 0.2),
+    'nuts': ('Protein', 0.3),
+    'produce': ('Produce', 0.3),
+    'vegetables': ('Produce', 0.3),
+    'veggies': ('Produce', 0.3),
+    'salad': ('Produce', 0.3),
+    'lettuce': ('Produce', 0.2),
+    'tomatoes': ('Produce', 0.4),
+    'potatoes': ('Produce', 0.2),
+    'onions': ('Produce', 0.2),
+    'carrots': ('Produce', 0.2),
+    'fruit': ('Produce', 0.3),
+    'apples': ('Produce', 0.2),
+    'apple': ('Produce', 0.2),
+    'bananas': ('Produce', 0.3),
+    'banana': ('Produce', 0.3),
+    'oranges': ('Produce', 0.3),
+    'berries': ('Produce', 0.5),
+    'avocado': ('Produce', 0.4),
+    'paper towels': ('Household', 0.6),
+    'toilet paper': ('Household', 0.5),
+    'detergent': ('Household', 0.7),
+    'soap': ('Household', 0.3),
+    'bags': ('Household', 0.1),
+    'batteries': ('Household', 0.9),
+    'chips': ('Snacks', 0.4),
+    'cookies': ('Snacks', 0.5),
+    'chocolate': ('Snacks', 1.9),
+}
+
+# Sourcing that changes an item's footprint: term -> carbon multiplier
+CARBON_MODIFIERS = {
+    'local': 0.8,
+    'locally grown': 0.8,
+    'organic': 0.9,
+    'reusable': 0.5,
+    'recycled': 0.7,
+    'imported': 1.3,
+    'air freight': 1.8,
+}
+
+# Used when no category term matches an item
+DEFAULT_CATEGORY = 'Uncategorized'
+DEFAULT_CARBON_KG = 0.5
+
+
+class PhraseAutomaton:
+    """Aho-Corasick automaton over word tokens.
+
+    Matching whole words instead of characters keeps the number of Python
+    steps per receipt line small while still finding every multi-word
+    phrase ("fair trade", "paper towels") in a single left-to-right pass.
+    Failure links are folded into the transition table when the automaton
+    is built, so matching is one dict lookup per word.
+    """
+
+    def __init__(self, phrases):
+        goto = [{}]
+        output = [[]]
+        for phrase, payload in phrases:
+            state = 0
+            for word in _WORD.findall(phrase.lower()):
+                next_state = goto[state].get(word)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][word] = next_state
+                    goto.append({})
+                    output.append([])
+                state = next_state
+            # A phrase may carry several payloads ("organic" is eco and a carbon modifier)
+            output[state].append(payload)
+
+        # Breadth-first: every state's failure target is complete before its children
+        fail = [0] * len(goto)
+        self._delta = [dict(goto[0])] + [None] * (len(goto) - 1)
+        queue = list(goto[0].values())
+        for state in queue:
+            output[state] = output[state] + output[fail[state]]
+            delta = dict(self._delta[fail[state]])
+            delta.update(goto[state])
+            self._delta[state] = delta
+            for word, next_state in goto[state].items():
+                fail[next_state] = self._delta[fail[state]].get(word, 0) if state else 0
+                queue.append(next_state)
+        self._output = [tuple(payloads) for payloads in output]
+
+    def find(self, words):
+        """Return the payloads of every phrase occurring in the word list"""
+        delta, output = self._delta, self._output
+        state = 0
+        found = []
+        for word in words:
+            state = delta[state].get(word, 0)
+            if output[state]:
+                found.extend(output[state])
+        return found
+
+
+def _lexicon_entries():
+    entries = [(term, ('eco', None)) for term in ECO_TERMS]
+    entries += [(term, ('non_eco', None)) for term in NON_ECO_TERMS]
+    entries += [(term, ('category', value)) for term, value in CATEGORY_TERMS.items()]
+    entries += [(term, ('carbon_modifier', value)) for term, value in CARBON_MODIFIERS.items()]
+    return entries
+
+
+_AUTOMATON = PhraseAutomaton(_lexicon_entries())
+
+
+def classify_item(name):
+    """Look up an item name in the lexicon.
+
+    Returns an (is_eco_friendly, category, kg CO2e per unit) tuple.
+    """
+    return _classify_words(tuple(_WORD.findall(name.lower())))
+
+
+# Item names repeat heavily across receipts from the same stores
+@lru_cache(maxsize=4096)
+def _classify_words(words):
+    eco = non_eco = False
+    category = None
+    carbon = DEFAULT_CARBON_KG
+    modifier = 1.0
+    for kind, value in _AUTOMATON.find(words):
+        if kind == 'eco':
+            eco = True
+        elif kind == 'non_eco':
+            non_eco = True
+        elif kind == 'category':
+            # The last category term wins: "chicken soup" is soup-like, "soup chicken" is chicken
+            category, carbon = value
+        else:
+            modifier *= value
+    return eco and not non_eco, category or DEFAULT_CATEGORY, carbon * modifier
+
+
+def _price(token):
+    """Parse a price token like "3.99", "$3.99" or "-1.00"; None if it is not one"""
+    # Cheap shape check first: most non-price tokens fail on the decimal separator
+    if len(token) < 4 or token[-3] not in '.,':
+        return None
+    match = _PRICE.fullmatch(token)
+    return float(match.group(1).replace(',', '.')) if match else None
+
+
+def tokenize_line(line):
+    """Split one receipt line into a (name, words, quantity, price) tuple.
+
+    ``words`` are the lowercased words of the name, ready for lexicon lookup.
+    Returns None for lines that are not items (headers, totals, payments).
+    """
+    tokens = line.split()
+    if len(tokens) < 2:
+        return None
+    # Trailing tax / department flag: "... 2.49 F"
+    last = tokens[-1]
+    if len(tokens) > 2 and len(last) <= 2 and last.isalpha() and last.isupper():
+        tokens.pop()
+    price = _price(tokens.pop())
+    if price is None:
+        return None
+
+    quantity = None
+    # UPC / SKU between the name and the price
+    if len(tokens) > 1 and len(tokens[-1]) >= 6 and tokens[-1].isdigit():
+        tokens.pop()
+    # Unit pricing: "2 @ 1.99" or "2@1.99"
+    if len(tokens) > 3 and tokens[-2] == '@' and tokens[-3].isdigit() and _price(tokens[-1]) is not None:
+        quantity = int(tokens[-3])
+        del tokens[-3:]
+    elif len(tokens) > 1 and '@' in tokens[-1]:
+        unit_price = _UNIT_PRICE.fullmatch(tokens[-1])
+        if unit_price:
+            quantity = int(unit_price.group(1))
+            tokens.pop()
+
+    # Leading list marker ("1.") and quantity ("2 x" or "2x")
+    first = tokens[0]
+    if first[-1] in '.)' and first[:-1].isdigit():
+        del tokens[0]
+    if quantity is None and len(tokens) > 1:
+        first = tokens[0]
+        if len(tokens) > 2 and tokens[1] in _QUANTITY_SEPARATORS and first.isdigit():
+            quantity = int(first)
+            del tokens[:2]
+        elif first[-1] in _QUANTITY_SEPARATORS and first[:-1].isdigit():
+            quantity = int(first[:-1])
+            del tokens[0]
+
+    name = ' '.join(tokens).strip('.:-*')
+    lowered = name.lower()
+    # A name needs at least one letter (upper() only changes strings with cased characters)
+    if lowered == name.upper():
+        return None
+    words = tuple(_WORD.findall(lowered))
+    if not SKIP_WORDS.isdisjoint(words):
+        return None
+    return name, words, quantity or 1, price
+
+
+def parse_receipt_items(text):
+    """Parse receipt text into structured items"""
+    items = []
+    if not text:
+        return items
+    for line in text.splitlines():
+        token = tokenize_line(line)
+        if token is None:
+            continue
+        name, words, quantity, price = token
+        is_eco, category, carbon_per_unit = _classify_words(words)
+        items.append({
+            'name': name,
+            'price': price,
+            'quantity': quantity,
+            'isEcoFriendly': is_eco,
+            'category': category,
+            'carbonFootprint': round(carbon_per_unit * quantity, 2)
+        })
+    return items
+
+
+def calculate_eco_score(items):
+    """Score 0-100: the share of spend going to eco-friendly items"""
+    total = sum(item['price'] for item in items)
+    if total <= 0:
+        return 0
+    eco_spend = sum(item['price'] for item in items if item['isEcoFriendly'])
+    return round(100 * eco_spend / total)
+
+
+def calculate_carbon_footprint(items):
+    """Total estimated kg CO2e for the parsed items"""
+    return round(sum(item['carbonFootprint'] for item in items), 1)
+
+
+def analyze_receipt(text):
+    """Parse receipt text and compute its eco score and carbon footprint"""
+    items = parse_receipt_items(text)
+    return {
+        'items': items,
+        'eco_score': calculate_eco_score(items),
+        'carbon_footprint': calculate_carbon_footprint(items)
+    }
@@ -0,0 +1,71 @@
+"""Single-flight request coalescing.
+
+When several callers ask for the same key at once, only the first (the
+leader) does the work; the others wait for it and share its result or
+exception. Once the call finishes the key is forgotten, so later requests
+start a fresh call.
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key across threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Run fn() unless a call for key is already in flight.
+
+        Returns a (result, shared) tuple where shared is True if the result
+        came from another caller's in-flight call.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = Future()
+                self._calls[key] = future
+                leader = True
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return future.result(), False
+
+
+class AsyncSingleFlight:
+    """Coalesce concurrent coroutines with the same key on one event loop"""
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, coroutine_fn):
+        """Await coroutine_fn() unless a call for key is already in flight.
+
+        Returns a (result, shared) tuple like SingleFlight.do.
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+            # shield so one impatient follower cannot cancel the shared call
+            return await asyncio.shield(task), True
+
+        task = asyncio.ensure_future(coroutine_fn())
+        self._calls[key] = task
+        task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task), False
@@ -4,4 +4,4 @@
 pip install -r requirements.txt
 
 # Start the application
-python app.py 
\ No newline at end of file
+exec gunicorn -c gunicorn.conf.py
\ No newline at end of file
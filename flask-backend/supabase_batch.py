@@ -0,0 +1,175 @@
+"""Planning for batched Supabase operations.
+
+A batch is an ordered list of proxy operations, and by default it runs in
+exactly that order: a later operation may depend on an earlier one (the
+receipt_items of a receipt need the receipts row to exist first). Only
+runs of consecutive selects, which cannot depend on each other, are sent
+concurrently. Consecutive inserts into a table with the same columns are
+merged into one bulk PostgREST insert and the returned rows are split back
+out per operation, so a receipt save (receipt items, wallet update, stats)
+costs one round trip per table instead of one per row. A bulk insert is a
+single statement, so the operations merged into it succeed or fail
+together; an insert sent with "merge": false always gets a call of its own.
+Every insert asks for its rows back, so its result data is the list of
+inserted rows whether or not it was merged.
+
+A batch sent with "parallel": true declares its tables independent: each
+table's operations keep their order but different tables run concurrently.
+
+Execution lives in app.py and async_app.py; this module only plans
+batches and shapes their results.
+"""
+import os
+import json
+
+MAX_BATCH_OPERATIONS = int(os.environ.get('SUPABASE_BATCH_MAX_OPERATIONS', 100))
+# Tables written or read at the same time within one batch
+BATCH_CONCURRENCY = int(os.environ.get('SUPABASE_BATCH_CONCURRENCY', 8))
+
+
+class Step:
+    """One upstream call, covering one or more operations of the batch"""
+
+    def __init__(self, table, operation, params, payload, indexes, row_counts=None):
+        self.table = table
+        self.operation = operation
+        self.params = params
+        self.payload = payload
+        self.indexes = indexes
+        # Rows each merged insert contributed, in order
+        self.row_counts = row_counts
+
+    @property
+    def merged(self):
+        return len(self.indexes) > 1
+
+
+def validate_operation(op, methods):
+    """Return an error message for a malformed batch operation, or None"""
+    if not isinstance(op, dict):
+        return 'Operation must be an object'
+    if not isinstance(op.get('table'), str) or not op['table']:
+        return 'Table name is required'
+    if op.get('operation', 'select') not in methods:
+        return 'Invalid operation'
+    if op.get('params') is not None and not isinstance(op['params'], dict):
+        return 'params must be an object'
+    if 'merge' in op and not isinstance(op['merge'], bool):
+        return 'merge must be a boolean'
+    return None
+
+
+def _insert_rows(op):
+    """Rows an insert writes, or None if its payload cannot be merged"""
+    data = op.get('data')
+    rows = data if isinstance(data, list) else [data]
+    if not rows or not all(isinstance(row, dict) for row in rows):
+        return None
+    return rows
+
+
+def plan_batch(operations, methods, parallel=False):
+    """Split a batch into phases of steps.
+
+    Returns (phases, errors). Phases run one after another; each phase is a
+    list of lanes that may run concurrently, and each lane is a list of
+    steps to run in order. errors maps the index of every invalid
+    operation to its message.
+
+    By default every write is a phase of its own, in caller order, and only
+    consecutive selects share a phase (one lane each). With parallel=True
+    the whole batch is one phase with a lane per table.
+    """
+    errors = {}
+    # Steps per lane key, in first-seen order: the table in parallel mode,
+    # else one lane for the whole batch
+    lanes = {}
+    for index, op in enumerate(operations):
+        error = validate_operation(op, methods)
+        if error:
+            errors[index] = error
+            continue
+        table = op['table']
+        operation = op.get('operation', 'select')
+        params = op.get('params') or {}
+        steps = lanes.setdefault(table if parallel else None, [])
+
+        rows = _insert_rows(op) if operation == 'insert' and op.get('merge', True) else None
+        if rows is not None:
+            # Only the step right before this one can be merged with it
+            previous = steps[-1] if steps and steps[-1].table == table else None
+            # PostgREST bulk inserts need every row to have the same keys
+            if (previous is not None and previous.operation == 'insert' and previous.row_counts
+                    and set(previous.payload[0]) == set(rows[0])
+                    and all(set(row) == set(rows[0]) for row in rows)):
+                previous.payload.extend(rows)
+                previous.indexes.append(index)
+                previous.row_counts.append(len(rows))
+                continue
+            if all(set(row) == set(rows[0]) for row in rows):
+                steps.append(Step(table, operation, params, list(rows), [index], [len(rows)]))
+                continue
+
+        steps.append(Step(table, operation, params, op.get('data', {}), [index]))
+
+    if parallel:
+        return ([list(lanes.values())] if lanes else []), errors
+    phases = []
+    for step in lanes.get(None, []):
+        if step.operation == 'select' and phases and phases[-1][0][0].operation == 'select':
+            # Reads cannot depend on each other
+            phases[-1].append([step])
+        else:
+            phases.append([[step]])
+    return phases, errors
+
+
+def count_steps(phases):
+    """Number of upstream calls a planned batch makes"""
+    return sum(len(lane) for phase in phases for lane in phase)
+
+
+def step_payload(step):
+    """Request body for a step: single inserts keep the client's original shape"""
+    if step.row_counts and not step.merged:
+        return step.payload if step.row_counts[0] != 1 else step.payload[0]
+    return step.payload
+
+
+def step_prefer(step):
+    """Prefer header for a step: inserts return their rows, merged or not"""
+    return 'return=representation' if step.operation == 'insert' else None
+
+
+def split_results(step, status, body):
+    """Turn one upstream response into a result for every operation in the step"""
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = None
+    if not step.merged:
+        return [{'index': step.indexes[0], 'status': status, 'data': data}]
+
+    # Merged inserts ask for the inserted rows back and hand each caller its share
+    if 200 <= status < 300 and isinstance(data, list) and len(data) == sum(step.row_counts):
+        results = []
+        start = 0
+        for index, count in zip(step.indexes, step.row_counts):
+            results.append({'index': index, 'status': status, 'data': data[start:start + count]})
+            start += count
+        return results
+    return [{'index': index, 'status': status, 'data': data} for index in step.indexes]
+
+
+def error_result(index, message):
+    return {'index': index, 'error': message}
+
+
+def ordered_results(count, errors, step_results):
+    """Assemble per-operation results in request order"""
+    results = [None] * count
+    for index, message in errors.items():
+        results[index] = error_result(index, message)
+    for result in step_results:
+        results[result['index']] = result
+    return results
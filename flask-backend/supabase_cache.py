@@ -0,0 +1,254 @@
+"""Read-through cache for Supabase selects made through the backend proxy.
+
+Select responses are kept as raw JSON bytes keyed by (table, query params,
+auth principal), so a hit is served straight from memory without touching
+Supabase or re-serializing anything. Each table has its own TTL; tables
+without one are never cached. Any insert, update or delete proxied for a
+table bumps that table's generation number. Entries remember the generation
+they were stored under and stop being served once it moves on, and a select
+that was already in flight cannot store pre-write rows afterwards.
+
+Generations live in a SQLite file shared by the gunicorn workers on the
+host, so a write through one worker invalidates the table in all of them.
+SUPABASE_CACHE_BACKEND=memory keeps them in process instead, which is only
+safe with a single worker.
+
+Every select response also carries an ETag, so clients that send
+If-None-Match get a 304 instead of the body.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+SUPABASE_CACHE_ENABLED = os.environ.get('SUPABASE_CACHE', 'True').lower() == 'true'
+SUPABASE_CACHE_MAX_ENTRIES = int(os.environ.get('SUPABASE_CACHE_SIZE', 2048))
+SUPABASE_CACHE_BACKEND = os.environ.get('SUPABASE_CACHE_BACKEND', 'sqlite').lower()
+SUPABASE_CACHE_DB_PATH = os.environ.get(
+    'SUPABASE_CACHE_DB', os.path.join(tempfile.gettempdir(), 'ecovision_supabase_cache.sqlite3'))
+
+# Seconds a select stays fresh, per table. Reference data changes rarely;
+# per-user tables get a short TTL because the frontend also writes to some
+# of them directly through supabase-js, bypassing invalidation.
+DEFAULT_TABLE_TTLS = {
+    'eco_actions': 300,
+    'badges': 300,
+    'categories': 300,
+    'user_stats': 15,
+    'users': 15,
+    'user_badges': 15,
+    'user_actions': 10,
+}
+
+
+def parse_table_ttls(value):
+    """Parse "table=seconds,table=seconds" overrides for the TTL table"""
+    ttls = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        try:
+            table, seconds = item.split('=', 1)
+            ttls[table.strip()] = float(seconds)
+        except ValueError:
+            logger.error(f"Ignoring invalid SUPABASE_CACHE_TTLS entry: {item}")
+    return ttls
+
+
+TABLE_TTLS = dict(DEFAULT_TABLE_TTLS, **parse_table_ttls(os.environ.get('SUPABASE_CACHE_TTLS')))
+
+CachedSelect = namedtuple('CachedSelect', ['body', 'status', 'etag', 'expires_at', 'generation'])
+
+
+def make_etag(body):
+    """Strong ETag for a response body"""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value matches etag (weak comparison)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def cache_key(table, params, auth_token):
+    """Key a select by table, canonical query params and auth principal.
+
+    The token is hashed rather than stored; row-level security means two
+    principals can see different rows for the same query.
+    """
+    principal = hashlib.sha256(auth_token.encode('utf-8')).hexdigest() if auth_token else ''
+    return (table, json.dumps(params or {}, sort_keys=True, separators=(',', ':')), principal)
+
+
+class MemoryGenerations:
+    """Per-table write generations local to this process"""
+
+    def __init__(self):
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def current(self, table):
+        return self._generations.get(table, 0)
+
+    def bump(self, table):
+        with self._lock:
+            self._generations[table] = self._generations.get(table, 0) + 1
+
+
+class SQLiteGenerations:
+    """Per-table write generations in a SQLite file shared by every worker process on the host"""
+
+    def __init__(self, db_path):
+        self._db = sqlite3.connect(db_path, timeout=1, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+        self._lock = threading.Lock()
+
+    def current(self, table):
+        """The table's generation, or None if the file cannot be read"""
+        try:
+            with self._lock:
+                row = self._db.execute("SELECT generation FROM generations WHERE name = ?", (table,)).fetchone()
+        except sqlite3.Error as e:
+            # Unknown means neither served from nor stored in the cache
+            logger.error(f"Supabase cache generations unavailable: {str(e)}")
+            return None
+        return row[0] if row else 0
+
+    def bump(self, table):
+        try:
+            with self._lock:
+                self._db.execute(
+                    "INSERT INTO generations (name, generation) VALUES (?, 1) "
+                    "ON CONFLICT(name) DO UPDATE SET generation = generation + 1", (table,))
+        except sqlite3.Error as e:
+            logger.error(f"Could not invalidate {table} for other workers: {str(e)}")
+
+
+class SelectCache:
+    """Thread-safe LRU of select responses with per-table TTLs and invalidation"""
+
+    def __init__(self, max_entries=2048, table_ttls=None, generations=None):
+        self.max_entries = max_entries
+        self.table_ttls = dict(table_ttls or {})
+        self.generations = generations if generations is not None else MemoryGenerations()
+        self._entries = OrderedDict()
+        self._tables = {}
+        # Bumped by clear(), which only empties this process's entries
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def ttl_for(self, table):
+        """TTL in seconds for table, or 0 if its selects are not cached"""
+        return self.table_ttls.get(table, 0)
+
+    def generation(self, table):
+        """Current write generation of table; pass it back to put()"""
+        return (self._epoch, self.generations.current(table))
+
+    def get(self, key):
+        """Return the fresh CachedSelect for key, or None"""
+        generation = self.generation(key[0])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires_at <= time.monotonic() or entry.generation != generation or generation[1] is None:
+                self._forget(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, generation, body, status):
+        """Store a select response unless its table was written since generation"""
+        table = key[0]
+        ttl = self.ttl_for(table)
+        entry = CachedSelect(body, status, make_etag(body), time.monotonic() + ttl, generation)
+        if ttl <= 0 or status != 200 or generation[1] is None:
+            return entry
+        current = self.generation(table)
+        with self._lock:
+            if current != generation:
+                return entry
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._tables.setdefault(table, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._forget(next(iter(self._entries)))
+        return entry
+
+    def invalidate(self, table):
+        """Drop every cached select for table after a write to it, in every worker"""
+        self.generations.bump(table)
+        with self._lock:
+            keys = self._tables.pop(table, ())
+            for key in keys:
+                self._entries.pop(key, None)
+            if keys:
+                self.invalidations += 1
+
+    def _forget(self, key):
+        self._entries.pop(key, None)
+        keys = self._tables.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._tables[key[0]]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tables.clear()
+            self._epoch += 1
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations
+            }
+
+
+def _make_generations():
+    if SUPABASE_CACHE_ENABLED and SUPABASE_CACHE_BACKEND == 'sqlite':
+        try:
+            return SQLiteGenerations(SUPABASE_CACHE_DB_PATH)
+        except sqlite3.Error as e:
+            # Without shared generations other workers could serve stale rows
+            logger.error(f"Supabase cache disabled, generations file unavailable: {str(e)}")
+            return None
+    return MemoryGenerations()
+
+
+_generations = _make_generations()
+
+# Shared cache used by both the Flask and aiohttp proxies
+select_cache = SelectCache(
+    SUPABASE_CACHE_MAX_ENTRIES, TABLE_TTLS if SUPABASE_CACHE_ENABLED and _generations is not None else {},
+    _generations)
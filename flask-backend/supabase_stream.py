@@ -0,0 +1,107 @@
+"""Zero-parse passthrough of PostgREST responses to the client.
+
+Large selects (scan history, receipt items) used to be downloaded in full,
+parsed and re-serialized before the client saw a byte. In passthrough
+mode the upstream body is relayed chunk by chunk exactly as Supabase sent
+it: the backend never parses it, and never holds more than one chunk.
+
+Compression is negotiated end to end. The content codings the client
+accepts (and that can be relayed untouched) are asked for upstream, and a
+compressed body is forwarded still compressed, so the proxy spends no CPU
+on gzip or brotli either way.
+
+Responses that the backend has to look inside are not streamed: cached
+selects and If-None-Match revalidations (the ETag is a hash of the body)
+and batches (split per operation) keep the buffered path.
+"""
+import os
+import zlib
+
+SUPABASE_PASSTHROUGH_ENABLED = os.environ.get('SUPABASE_PASSTHROUGH', 'True').lower() == 'true'
+PASSTHROUGH_CHUNK_BYTES = int(os.environ.get('SUPABASE_PASSTHROUGH_CHUNK_BYTES', 64 * 1024))
+
+# Content codings relayed as-is, in order of preference
+PASSTHROUGH_ENCODINGS = ('br', 'gzip')
+
+# Upstream headers that describe the body or the result set
+FORWARDED_HEADERS = ('Content-Type', 'Content-Range', 'ETag', 'Preference-Applied', 'Location')
+
+
+def parse_accept_encoding(value):
+    """Map each coding in an Accept-Encoding header to its q-value"""
+    codings = {}
+    for item in (value or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, number = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        codings[coding] = quality
+    return codings
+
+
+def accepts(codings, coding):
+    """Whether parsed Accept-Encoding codings allow coding"""
+    if coding in ('', 'identity'):
+        return codings.get('identity', 1.0) > 0
+    return codings.get(coding, codings.get('*', 0.0)) > 0
+
+
+def upstream_accept_encoding(client_accept_encoding):
+    """The Accept-Encoding to send upstream for a client's Accept-Encoding"""
+    codings = parse_accept_encoding(client_accept_encoding)
+    relayed = [coding for coding in PASSTHROUGH_ENCODINGS if accepts(codings, coding)]
+    return ', '.join(relayed + ['identity']) if relayed else 'identity'
+
+
+def response_headers(upstream_headers, client_accept_encoding):
+    """Headers for the relayed response, and whether the body must be decoded first.
+
+    The body is decoded only if upstream used a coding the client did not
+    ask for, which a well-behaved upstream never does.
+    """
+    headers = {name: upstream_headers[name] for name in FORWARDED_HEADERS if name in upstream_headers}
+    headers.setdefault('Content-Type', 'application/json')
+    headers['Vary'] = 'Accept-Encoding'
+    encoding = upstream_headers.get('Content-Encoding', '').strip().lower()
+    decode = not accepts(parse_accept_encoding(client_accept_encoding), encoding)
+    if not decode:
+        if encoding and encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        if 'Content-Length' in upstream_headers:
+            # The exact upstream bytes are sent, so the length still holds
+            headers['Content-Length'] = upstream_headers['Content-Length']
+    return headers, decode
+
+
+def content_decoder(encoding):
+    """A zlib decompressor for a gzip or deflate body, or None for other codings"""
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        # Detects the gzip or zlib header by itself
+        return zlib.decompressobj(wbits=zlib.MAX_WBITS | 32)
+    return None
+
+
+def iter_body(response, decoder=None, chunk_size=PASSTHROUGH_CHUNK_BYTES):
+    """Yield a streamed requests response's raw body in chunks, then release the connection"""
+    finished = False
+    try:
+        for chunk in response.raw.stream(chunk_size, decode_content=False):
+            yield decoder.decompress(chunk) if decoder else chunk
+        if decoder:
+            yield decoder.flush()
+        finished = True
+    finally:
+        if finished:
+            # Fully read, so the connection can serve the next request
+            response.raw.release_conn()
+        else:
+            # The client went away mid-body; the rest is never read
+            response.close()
@@ -0,0 +1,175 @@
+"""Size-bounded, streaming ingestion of uploaded images.
+
+Uploads are read in chunks into a spooled buffer (memory up to a
+threshold, then a temp file) while being hashed and size-checked,
+downsampled to the resolution the upstream model needs, and
+base64-encoded chunk by chunk straight into the outbound request body.
+"""
+import io
+import os
+import base64
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Receipt upload limits
+MAX_RECEIPT_BYTES = int(os.environ.get('MAX_RECEIPT_BYTES', 15 * 1024 * 1024))
+# Raw image uploads for classification (clients downscale before sending)
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', 10 * 1024 * 1024))
+SPOOL_MEMORY_BYTES = int(os.environ.get('UPLOAD_SPOOL_MEMORY_BYTES', 1024 * 1024))
+# Longest side sent for OCR; receipts stay legible well below phone-camera resolution
+RECEIPT_MAX_SIDE = int(os.environ.get('RECEIPT_MAX_SIDE', 1600))
+RECEIPT_JPEG_QUALITY = int(os.environ.get('RECEIPT_JPEG_QUALITY', 85))
+
+READ_CHUNK_BYTES = 64 * 1024
+# A multiple of 3 so every chunk base64-encodes without padding
+BASE64_CHUNK_BYTES = 48 * 1024
+
+
+class UploadTooLarge(ValueError):
+    """Raised when an upload exceeds its size limit"""
+
+
+class UploadSpool:
+    """Bounded buffer for an upload arriving in chunks.
+
+    Data stays in memory up to SPOOL_MEMORY_BYTES and then moves to a temp
+    file; it is hashed and size-checked as it is written.
+    """
+
+    def __init__(self, limit=MAX_RECEIPT_BYTES):
+        self.limit = limit
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+        self._digest = hashlib.sha256()
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.limit:
+            raise UploadTooLarge(f'Upload exceeds {self.limit} bytes')
+        self._digest.update(chunk)
+        self.file.write(chunk)
+
+    @property
+    def digest(self):
+        return self._digest.hexdigest()
+
+    def rewind(self):
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class UploadBuffer:
+    """In-memory counterpart of UploadSpool for uploads needed as bytes anyway"""
+
+    def __init__(self, limit=MAX_IMAGE_BYTES):
+        self.limit = limit
+        self._buffer = bytearray()
+        self._digest = hashlib.sha256()
+
+    def write(self, chunk):
+        if len(self._buffer) + len(chunk) > self.limit:
+            raise UploadTooLarge(f'Upload exceeds {self.limit} bytes')
+        self._digest.update(chunk)
+        self._buffer += chunk
+
+    @property
+    def digest(self):
+        return self._digest.hexdigest()
+
+    def getvalue(self):
+        return bytes(self._buffer)
+
+
+def read_upload(fileobj, limit=MAX_IMAGE_BYTES):
+    """Read a raw upload stream in chunks, hashing and size-checking it.
+
+    Returns a (sha256 hex digest, bytes) tuple; raises UploadTooLarge past
+    ``limit`` bytes without reading the rest.
+    """
+    buffer = UploadBuffer(limit)
+    while True:
+        chunk = fileobj.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        buffer.write(chunk)
+    return buffer.digest, buffer.getvalue()
+
+
+def hash_upload(fileobj, limit=MAX_RECEIPT_BYTES):
+    """Hash and size-check an already spooled upload in place.
+
+    Werkzeug spools multipart files itself, so there is no need to copy
+    them again. Returns a (sha256 hex digest, size) tuple with the file
+    rewound; raises UploadTooLarge past ``limit`` bytes.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = fileobj.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise UploadTooLarge(f'Upload exceeds {limit} bytes')
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest(), size
+
+
+def downsample_receipt(fileobj, max_side=RECEIPT_MAX_SIDE, quality=RECEIPT_JPEG_QUALITY):
+    """Re-encode a receipt photo as a grayscale JPEG at OCR resolution.
+
+    JPEGs are scaled during decode so a 12 MP photo is never fully
+    decompressed. Anything Pillow cannot decode is returned unchanged.
+    """
+    # Imported here so workers that never see a receipt do not pay for Pillow
+    from PIL import Image
+
+    try:
+        img = Image.open(fileobj)
+        img.draft('L', (max_side, max_side))
+        img = img.convert('L')
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=2.0)
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=quality, optimize=True)
+        return buffer.getbuffer()
+    except Exception as e:
+        logger.warning(f"Could not downsample receipt, sending original: {str(e)}")
+        fileobj.seek(0)
+        return fileobj.read()
+
+
+def downsample_receipt_bytes(data):
+    """downsample_receipt() for an in-memory upload, returning picklable bytes"""
+    return bytes(downsample_receipt(io.BytesIO(data)))
+
+
+def iter_base64(data, chunk_size=BASE64_CHUNK_BYTES):
+    """Yield the base64 encoding of data in ASCII chunks"""
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield base64.b64encode(view[start:start + chunk_size])
+
+
+def iter_json_with_base64(prefix, image, suffix):
+    """Stream a JSON body whose image field is base64-encoded on the fly.
+
+    ``prefix`` must end with an opening quote and ``suffix`` start with the
+    closing one, e.g. b'{"image": "' and b'", "format": "json"}'.
+    """
+    yield prefix
+    yield from iter_base64(image)
+    yield suffix
@@ -7,6 +7,16 @@ console.log('Using API base URL for trash scanner:', API_BASE_URL);
 // Flag to enable offline mode if backend is unavailable
 let OFFLINE_MODE = false;
 
+// Send scans as raw image bytes; turned off if the backend only accepts base64 JSON
+let BINARY_UPLOADS = true;
+
+// Ask for results as Server-Sent Events; turned off if the backend answers with plain JSON
+let STREAMING = true;
+
+// Longest side of uploaded scans; the backend resizes to this before classifying anyway
+const MAX_UPLOAD_SIDE = 1024;
+const UPLOAD_QUALITY = 0.85;
+
 // Ensure we're not using the old Vercel backend
 if (API_BASE_URL.includes('vercel.app')) {
   console.error('Error: Still using Vercel backend URL. Please update your environment variables.');
@@ -72,6 +82,180 @@ function formatImageData(imageData: string): string {
   return `data:image/jpeg;base64,${imageData}`;
 }
 
+/**
+ * Encodes a canvas as a Blob of the given type
+ * @param canvas - The canvas to encode
+ * @param type - The image MIME type to request
+ * @returns A promise that resolves to the Blob, or null if encoding failed
+ */
+function canvasToBlob(canvas: HTMLCanvasElement, type: string): Promise<Blob | null> {
+  return new Promise(resolve => canvas.toBlob(resolve, type, UPLOAD_QUALITY));
+}
+
+/**
+ * Downscales an image and re-encodes it as WebP (or JPEG where WebP encoding is unsupported)
+ * @param imageData - The image as a data URI
+ * @returns A promise that resolves to the compressed image
+ */
+async function toUploadBlob(imageData: string): Promise<Blob> {
+  const source = await (await fetch(imageData)).blob();
+  const bitmap = await createImageBitmap(source);
+  const scale = Math.min(1, MAX_UPLOAD_SIDE / Math.max(bitmap.width, bitmap.height));
+  
+  const canvas = document.createElement('canvas');
+  canvas.width = Math.max(1, Math.round(bitmap.width * scale));
+  canvas.height = Math.max(1, Math.round(bitmap.height * scale));
+  const context = canvas.getContext('2d');
+  if (!context) {
+    throw new Error('Canvas is not available');
+  }
+  context.drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+  bitmap.close();
+  
+  // Browsers that cannot encode WebP silently return PNG instead
+  const webp = await canvasToBlob(canvas, 'image/webp');
+  if (webp && webp.type === 'image/webp') {
+    return webp;
+  }
+  const jpeg = await canvasToBlob(canvas, 'image/jpeg');
+  if (!jpeg) {
+    throw new Error('Could not encode image');
+  }
+  return jpeg;
+}
+
+/**
+ * Splits a Server-Sent Events response body into events
+ * @param response - A fetch response with a text/event-stream body
+ */
+async function* readEvents(response: Response): AsyncGenerator<{ event: string; data: string }> {
+  const reader = response.body!.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) {
+      return;
+    }
+    buffer += decoder.decode(value, { stream: true });
+    let boundary: number;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      let event = 'message';
+      const data: string[] = [];
+      for (const line of block.split('\n')) {
+        if (line.startsWith('event:')) {
+          event = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+          data.push(line.slice(5).trimStart());
+        }
+      }
+      if (data.length) {
+        yield { event, data: data.join('\n') };
+      }
+    }
+  }
+}
+
+/**
+ * Sends a scan and reads the result field by field as the backend streams it
+ * @param blob - The compressed image
+ * @param onPartial - Called with the fields received so far, as they arrive
+ * @returns A promise that resolves to the classification result, or null if the
+ * backend could not stream it
+ */
+async function classifyStreaming(
+  blob: Blob,
+  onPartial: (fields: Partial<TrashScanResult>) => void
+): Promise<TrashScanResult | null> {
+  const controller = new AbortController();
+  const timeout = setTimeout(() => controller.abort(), 30000);
+  try {
+    const response = await fetch(`${API_BASE_URL}/api/classify-trash?mode=stream`, {
+      method: 'POST',
+      body: blob,
+      headers: {
+        'Accept': 'text/event-stream',
+        'Content-Type': blob.type
+      },
+      signal: controller.signal
+    });
+    if (!response.ok || !response.body) {
+      return null;
+    }
+    if (!response.headers.get('Content-Type')?.startsWith('text/event-stream')) {
+      // Older backends ignore ?mode=stream and answer with the whole result
+      STREAMING = false;
+      return await response.json();
+    }
+    
+    let fields: Partial<TrashScanResult> = {};
+    for await (const { event, data } of readEvents(response)) {
+      if (event === 'partial') {
+        fields = { ...fields, ...JSON.parse(data) };
+        onPartial(fields);
+      } else if (event === 'result') {
+        return JSON.parse(data);
+      }
+    }
+    return null;
+  } catch (error) {
+    console.warn('Streaming classification failed, retrying without streaming:', error);
+    return null;
+  } finally {
+    clearTimeout(timeout);
+  }
+}
+
+/**
+ * Sends a scan as raw image bytes instead of base64 inside JSON
+ * @param imageData - The image as a data URI
+ * @param onPartial - If given, the result is streamed and this is called as fields arrive
+ * @returns A promise that resolves to the classification result, or null if the
+ * backend does not accept binary uploads
+ */
+async function classifyBinary(
+  imageData: string,
+  onPartial?: (fields: Partial<TrashScanResult>) => void
+): Promise<TrashScanResult | null> {
+  let blob: Blob;
+  try {
+    blob = await toUploadBlob(imageData);
+  } catch (error) {
+    console.warn('Could not compress image, sending base64 instead:', error);
+    return null;
+  }
+  
+  console.log(`Sending ${blob.size} byte ${blob.type} image`);
+  if (onPartial && STREAMING) {
+    const streamed = await classifyStreaming(blob, onPartial);
+    if (streamed) {
+      return streamed;
+    }
+  }
+  try {
+    const response = await axios.post(`${API_BASE_URL}/api/classify-trash`, blob, {
+      timeout: 30000,
+      headers: {
+        'Accept': 'application/json',
+        'Content-Type': blob.type
+      }
+    });
+    return response.data;
+  } catch (error) {
+    // Only a 415 means the body format was refused; anything else is a real
+    // failure and is rethrown like on the JSON path
+    const status = axios.isAxiosError(error) ? error.response?.status : undefined;
+    if (status === 415) {
+      console.warn('Backend does not accept binary uploads, falling back to base64 JSON');
+      BINARY_UPLOADS = false;
+      return null;
+    }
+    throw error;
+  }
+}
+
 /**
  * Tests the connection to the API server
  * @returns A promise that resolves to true if the server is reachable
@@ -119,9 +303,14 @@ export const testApiConnection = async (): Promise<boolean> => {
 /**
  * Uploads an image to the trash scanner API and returns the classification result
  * @param imageBase64 - The base64-encoded image data
+ * @param onPartial - Optional; called with the fields received so far (category and
+ * confidence first) while the backend is still writing the rest
  * @returns A promise that resolves to the classification result
  */
-export const classifyTrashImage = async (imageBase64: string): Promise<TrashScanResult> => {
+export const classifyTrashImage = async (
+  imageBase64: string,
+  onPartial?: (fields: Partial<TrashScanResult>) => void
+): Promise<TrashScanResult> => {
   try {
     // If offline mode is enabled, return a mock result
     if (OFFLINE_MODE) {
@@ -144,6 +333,14 @@ export const classifyTrashImage = async (imageBase64: string): Promise<TrashScan
     console.log('Sending request to:', `${API_BASE_URL}/api/classify-trash`);
     
     try {
+      if (BINARY_UPLOADS) {
+        const result = await classifyBinary(formattedImageData, onPartial);
+        if (result) {
+          console.log('API response:', result);
+          return result;
+        }
+      }
+      
       const response = await axios.post(`${API_BASE_URL}/api/classify-trash`, {
         image: formattedImageData
       }, {
@@ -167,8 +167,12 @@ const TrashScanner = () => {
         });
       }
 
-      // Call the API to classify the image
-      const result = await classifyTrashImage(base64Image);
+      // Call the API to classify the image, showing the category as soon as it arrives
+      const result = await classifyTrashImage(base64Image, (fields) => {
+        if (fields.category) {
+          setScanResult({ confidence: 0, details: '', tips: [], ...fields, category: fields.category });
+        }
+      });
       
       // Check if the result indicates offline mode was used
       if (result.offline_mode && !offlineMode) {